@@ -0,0 +1,277 @@
+from board import GameState, all_squares
+
+# Bit i of a bitboard is square i of GameState.board, i.e. bit 0 is a8 and bit 63 is h1.
+# Directions as (file step, row step), rooks use the first four and bishops the last four.
+# Even directions move towards higher square indices, odd ones towards lower indices.
+directions = [(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (-1, -1), (-1, 1), (1, -1)]
+
+
+def init_rays():
+    rays = [[0] * 64 for _ in range(8)]
+    for d, (df, dr) in enumerate(directions):
+        for sq in range(64):
+            f, r = (sq & 7) + df, (sq >> 3) + dr
+            while 0 <= f < 8 and 0 <= r < 8:
+                rays[d][sq] |= 1 << ((r << 3) + f)
+                f, r = f + df, r + dr
+    return rays
+
+
+def init_leaper(steps):
+    table = [0] * 64
+    for sq in range(64):
+        for df, dr in steps:
+            f, r = (sq & 7) + df, (sq >> 3) + dr
+            if 0 <= f < 8 and 0 <= r < 8:
+                table[sq] |= 1 << ((r << 3) + f)
+    return table
+
+
+rays = init_rays()
+knight_attacks = init_leaper(
+    [(1, 2), (2, 1), (-1, 2), (-2, 1), (1, -2), (2, -1), (-1, -2), (-2, -1)]
+)
+king_attacks = init_leaper(
+    [(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1)]
+)
+# Squares attacked by a pawn standing on a square, indexed by side (white moves up the board)
+pawn_attacks = [init_leaper([(1, -1), (-1, -1)]), init_leaper([(1, 1), (-1, 1)])]
+last_ranks = 0xFF | 0xFF << 56
+
+
+# Classical ray lookup, the ray is cut off behind the first blocker in its direction
+def ray_attacks(sq, occ, d):
+    ray = rays[d][sq]
+    blockers = ray & occ
+    if blockers:
+        if d & 1:
+            ray ^= rays[d][blockers.bit_length() - 1]
+        else:
+            ray ^= rays[d][(blockers & -blockers).bit_length() - 1]
+    return ray
+
+
+def rook_attacks(sq, occ):
+    return (
+        ray_attacks(sq, occ, 0)
+        | ray_attacks(sq, occ, 1)
+        | ray_attacks(sq, occ, 2)
+        | ray_attacks(sq, occ, 3)
+    )
+
+
+def bishop_attacks(sq, occ):
+    return (
+        ray_attacks(sq, occ, 4)
+        | ray_attacks(sq, occ, 5)
+        | ray_attacks(sq, occ, 6)
+        | ray_attacks(sq, occ, 7)
+    )
+
+
+class BitboardGameState(GameState):
+    def __init__(self):
+        super().__init__()
+        self.init_bitboards()
+
+    def init_bitboards(self):
+        self.bitboards = [0] * 12
+        self.occupancy = [0, 0]
+        for loc, piece in enumerate(self.board):
+            if piece != 12:
+                self.bitboards[piece] |= 1 << loc
+                self.occupancy[piece & 1] |= 1 << loc
+
+    def move_piece(self, start, end):
+        piece_start, piece_end = self.board[start], self.board[end]
+        super().move_piece(start, end)
+
+        if piece_end != 12:
+            self.bitboards[piece_end] ^= 1 << end
+            self.occupancy[piece_end & 1] ^= 1 << end
+
+        from_to = (1 << start) | (1 << end)
+        self.bitboards[piece_start] ^= from_to
+        self.occupancy[piece_start & 1] ^= from_to
+
+    def set_piece(self, loc, piece):
+        piece_at_loc = self.board[loc]
+        super().set_piece(loc, piece)
+
+        if piece_at_loc != 12:
+            self.bitboards[piece_at_loc] ^= 1 << loc
+            self.occupancy[piece_at_loc & 1] ^= 1 << loc
+
+        if piece != 12:
+            self.bitboards[piece] |= 1 << loc
+            self.occupancy[piece & 1] |= 1 << loc
+
+    def build_fen(self, fen, new=True):
+        # pieces are placed through set_piece, so start from empty bitboards
+        self.bitboards = [0] * 12
+        self.occupancy = [0, 0]
+        super().build_fen(fen, new)
+
+    # All pieces of side attacking loc given the occupancy occ
+    def attackers(self, loc, side, occ):
+        bb = self.bitboards
+        return (
+            (pawn_attacks[side ^ 1][loc] & bb[side])
+            | (knight_attacks[loc] & bb[2 + side])
+            | (king_attacks[loc] & bb[10 + side])
+            | (bishop_attacks(loc, occ) & (bb[4 + side] | bb[8 + side]))
+            | (rook_attacks(loc, occ) & (bb[6 + side] | bb[8 + side]))
+        )
+
+    def attacker_locs(self, loc, side):
+        attackers = self.attackers(loc, side, self.occupancy[0] | self.occupancy[1])
+        locs = []
+        while attackers:
+            bit = attackers & -attackers
+            attackers ^= bit
+            locs.append(bit.bit_length() - 1)
+        return locs
+
+    def king_safe(self, loc, side):
+        # own king does not block sliding attacks, so it can't hide behind itself
+        occ = (self.occupancy[0] | self.occupancy[1]) & ~self.bitboards[10 + side]
+        return not self.attackers(loc, side ^ 1, occ)
+
+    def get_masks(self):
+        if self.masks is not None:
+            return self.masks
+
+        side = self.cur_player
+        bb = self.bitboards
+        own = self.occupancy[side]
+        occ = own | self.occupancy[side ^ 1]
+        kloc = bb[10 + side].bit_length() - 1
+        checkers = self.attackers(kloc, side ^ 1, occ)
+        blocks, pinned = 0, {}
+
+        # Walk each ray from the king, an enemy slider behind the first piece is either
+        # giving check or pinning that piece if it belongs to us
+        for d in range(8):
+            sliders = bb[8 + side ^ 1] | (bb[6 + side ^ 1] if d < 4 else bb[4 + side ^ 1])
+            if not rays[d][kloc] & sliders:
+                continue
+            ray = ray_attacks(kloc, occ, d)
+            first = ray & occ
+            if first & sliders:
+                blocks |= ray
+            elif first & own:
+                ray = ray_attacks(kloc, occ ^ first, d)
+                if ray & sliders:
+                    pinned[first.bit_length() - 1] = ray
+
+        if not checkers:
+            check_mask = all_squares
+        elif checkers & (checkers - 1):
+            check_mask = 0
+        else:
+            check_mask = checkers | blocks
+
+        self.masks = (check_mask, pinned)
+        return self.masks
+
+    def test_king_safety(self, move):
+        start, end = move
+        piece = self.board[start]
+        side = piece & 1
+        occ = (self.occupancy[0] | self.occupancy[1]) & ~(1 << start) | (1 << end)
+        captured = 1 << end
+
+        # if enpassant, the captured pawn is behind the end square
+        if piece >> 1 == 0 and end == self.enpas:
+            cap = end + 8 if side == 0 else end - 8
+            occ ^= 1 << cap
+            captured |= 1 << cap
+
+        kloc = end if piece >> 1 == 5 else self.bitboards[10 + side].bit_length() - 1
+        return not self.attackers(kloc, side ^ 1, occ) & ~captured
+
+    def generate_moves(self, start, test=False, quiet=False):
+        piece = self.board[start]
+        piece_value = piece >> 1
+        side = piece & 1
+        own = self.occupancy[side]
+        occ = own | self.occupancy[side ^ 1]
+        moves = []
+
+        # Squares a non-king piece can move to without leaving the ally king in check
+        check_mask, pinned = self.get_masks()
+        allowed = check_mask & pinned[start] if start in pinned else check_mask
+        enpas = 0
+
+        # Generate the set of pseudo-legal target squares for the piece
+        if piece_value == 0:
+            targets = pawn_attacks[side][start] & self.occupancy[side ^ 1]
+            loc = self.enpas
+            if (
+                loc is not None
+                and pawn_attacks[side][start] >> loc & 1
+                and self.board[loc + 8 if side == 0 else loc - 8] == side ^ 1
+                and self.test_king_safety((start, loc))
+            ):
+                enpas = 1 << loc
+
+            off = 8 if side else -8
+            if not occ >> (start + off) & 1:
+                targets |= 1 << (start + off)
+                # If pawn on home rank
+                if start >> 3 == (1 if side else 6) and not occ >> (start + 2 * off) & 1:
+                    targets |= 1 << (start + 2 * off)
+        elif piece_value == 5:
+            targets = king_attacks[start] & ~own
+        elif not allowed:
+            targets = 0
+        elif piece_value == 1:
+            targets = knight_attacks[start] & ~own
+        elif piece_value == 2:
+            targets = bishop_attacks(start, occ) & ~own
+        elif piece_value == 3:
+            targets = rook_attacks(start, occ) & ~own
+        else:
+            targets = (bishop_attacks(start, occ) | rook_attacks(start, occ)) & ~own
+
+        if piece_value != 5:
+            targets = targets & allowed | enpas
+
+        # Promotions and captures (en passant included) aren't quiet
+        if quiet:
+            targets &= ~occ & ~(last_ranks | enpas) if piece_value == 0 else ~occ
+
+        while targets:
+            bit = targets & -targets
+            targets ^= bit
+            end = bit.bit_length() - 1
+            # King moves are checked one by one, the rest are legal by the masks
+            if piece_value == 5 and not self.test_king_safety((start, end)):
+                continue
+            if test:
+                return True
+            # If pawn promoting
+            if piece_value == 0 and end >> 3 in (0, 7):
+                moves += [(start, end + (i << 2)) for i in range(1, 5)]
+            else:
+                moves.append((start, end))
+
+        # If king can castle, path must be empty and not pass through check
+        if piece_value == 5 and not self.check:
+            king_side, queen_side = (
+                (self.brtc_king_side, self.brtc_queen_side)
+                if side
+                else (self.wrtc_king_side, self.wrtc_queen_side)
+            )
+            for off, castle in ((1, king_side), (-1, queen_side)):
+                if not castle:
+                    continue
+                path = 3 << start + 1 if off == 1 else 7 << start - 3
+                if (
+                    not occ & path
+                    and self.king_safe(start + off, side)
+                    and self.king_safe(start + 2 * off, side)
+                ):
+                    moves.append((start, start + 2 * off))
+
+        return moves
@@ -1,4 +1,19 @@
-import random
+from chess.polyglot import POLYGLOT_RANDOM_ARRAY
+from pesto import mg_table, eg_table, gamephaseInc
+
+all_squares = (1 << 64) - 1
+
+# Fixed Polyglot keys, so hashes are the same across runs, processes and opening books.
+# Pieces are indexed [piece][square] using the board's own numbering.
+zobrist_pieces = [
+    [POLYGLOT_RANDOM_ARRAY[((piece ^ 1) << 6) + (sq ^ 56)] for sq in range(64)]
+    for piece in range(12)
+]
+zobrist_castling = POLYGLOT_RANDOM_ARRAY[768:772]  # K, Q, k, q
+zobrist_enpas = POLYGLOT_RANDOM_ARRAY[772:780]  # by file
+zobrist_white = POLYGLOT_RANDOM_ARRAY[780]
+
+pvals = [88, 309, 331, 495, 981, 10000, 0]
 
 class GameState:
     def __init__(self):
@@ -80,19 +95,71 @@ class GameState:
         self.white_atkd, self.black_atkd = [], []
         self.cur_player = 0
         self.prev_moves = []
+        self.undo_stack = []
+        self.null_stack = []
+        self.enpas = None
+        self.halfmove, self.fullmove = 0, 1
+        self.masks = None
         self.promo = False
 
         self.all_board_positions = [self.board_to_fen()]
-        self.zobrist_table = self.init_zobrist()
+        self.mg, self.eg, self.game_phase = self.init_eval()
+        self.piece_count, self.side_count, self.material = self.init_material()
+        self.zobrist = self.init_zobrist()
+        self.key_history = [self.zobrist]
 
+    # Full hash of the position, afterwards it's kept up to date move by move
     def init_zobrist(self):
-        table = [[random.getrandbits(64) for _ in range(12)] for _ in range(64)]
-
-        # bitstrings for castling rights and enpasant files
-        for i in range(13):
-            table.append(random.getrandbits(64))
-
-        return table
+        h = 0
+        for i in range(64):
+            piece = self.board[i]
+            if piece != 12:
+                h ^= zobrist_pieces[piece][i]
+
+        if self.cur_player == 0:
+            h ^= zobrist_white
+
+        rtc = [self.wrtc_king_side, self.wrtc_queen_side, self.brtc_king_side, self.brtc_queen_side]
+        for i in range(len(rtc)):
+            if rtc[i]:
+                h ^= zobrist_castling[i]
+
+        return h ^ self.enpas_key()
+
+    # Full PeSTO sums of the position, afterwards they are kept up to date by
+    # move_piece and set_piece, so unmaking a move restores them as well
+    def init_eval(self):
+        mg, eg, game_phase = [0, 0], [0, 0], 0
+        for sq in range(64):
+            piece = self.board[sq]
+            if piece != 12:
+                mg[piece & 1] += mg_table[piece << 6 | sq]
+                eg[piece & 1] += eg_table[piece << 6 | sq]
+                game_phase += gamephaseInc[piece]
+        return mg, eg, game_phase
+
+    # Pieces of each kind, pieces of each side and white's material minus black's
+    # (kings left out), kept up to date by move_piece and set_piece
+    def init_material(self):
+        piece_count, side_count, material = [0] * 12, [0, 0], 0
+        for piece in self.board:
+            if piece != 12:
+                piece_count[piece] += 1
+                side_count[piece & 1] += 1
+                if piece >> 1 != 5:
+                    material += -pvals[piece >> 1] if piece & 1 else pvals[piece >> 1]
+        return piece_count, side_count, material
+
+    # Polyglot only hashes the enpassant file if a pawn can actually capture there
+    def enpas_key(self):
+        enpas = self.enpas
+        if enpas is None:
+            return 0
+        pawn = self.cur_player
+        for loc in (enpas + 7, enpas + 9) if pawn == 0 else (enpas - 7, enpas - 9):
+            if self.board[loc] == pawn and abs((loc & 7) - (enpas & 7)) == 1:
+                return zobrist_enpas[enpas & 7]
+        return 0
 
     def print_board(self):
         for i in range(0, 64, 8):
@@ -113,10 +180,21 @@ class GameState:
         locs[piece_start][locs[piece_start].index(start)] = end
         self.board[start] = 12
         self.board[end] = piece_start
+        self.zobrist ^= zobrist_pieces[piece_start][start] ^ zobrist_pieces[piece_start][end]
+        side = piece_start & 1
+        self.mg[side] += mg_table[piece_start << 6 | end] - mg_table[piece_start << 6 | start]
+        self.eg[side] += eg_table[piece_start << 6 | end] - eg_table[piece_start << 6 | start]
 
         if piece_end != 12:
             locs = self.blocs if piece_end & 1 else self.wlocs
             locs[piece_end].remove(end)
+            self.zobrist ^= zobrist_pieces[piece_end][end]
+            self.mg[side ^ 1] -= mg_table[piece_end << 6 | end]
+            self.eg[side ^ 1] -= eg_table[piece_end << 6 | end]
+            self.game_phase -= gamephaseInc[piece_end]
+            self.piece_count[piece_end] -= 1
+            self.side_count[side ^ 1] -= 1
+            self.material += pvals[piece_end >> 1] if side ^ 1 else -pvals[piece_end >> 1]
 
     def set_piece(self, loc, piece):
         piece_at_loc = self.board[loc]
@@ -125,10 +203,26 @@ class GameState:
         if piece != 12:
             locs = self.blocs if piece & 1 else self.wlocs
             locs[piece].append(loc)
+            self.zobrist ^= zobrist_pieces[piece][loc]
+            self.mg[piece & 1] += mg_table[piece << 6 | loc]
+            self.eg[piece & 1] += eg_table[piece << 6 | loc]
+            self.game_phase += gamephaseInc[piece]
+            self.piece_count[piece] += 1
+            self.side_count[piece & 1] += 1
+            if piece >> 1 != 5:
+                self.material += -pvals[piece >> 1] if piece & 1 else pvals[piece >> 1]
 
         if piece_at_loc != 12:
             locs = self.blocs if piece_at_loc & 1 else self.wlocs
             locs[piece_at_loc].remove(loc)
+            self.zobrist ^= zobrist_pieces[piece_at_loc][loc]
+            self.mg[piece_at_loc & 1] -= mg_table[piece_at_loc << 6 | loc]
+            self.eg[piece_at_loc & 1] -= eg_table[piece_at_loc << 6 | loc]
+            self.game_phase -= gamephaseInc[piece_at_loc]
+            self.piece_count[piece_at_loc] -= 1
+            self.side_count[piece_at_loc & 1] -= 1
+            if piece_at_loc >> 1 != 5:
+                self.material += pvals[piece_at_loc >> 1] if piece_at_loc & 1 else -pvals[piece_at_loc >> 1]
 
     def update_captures(self):
         self.white_captured, self.black_captured = [], []
@@ -145,20 +239,95 @@ class GameState:
 
         if len(self.all_board_positions) > 1:
             self.all_board_positions.pop()
-        if len(self.prev_moves) > 0:
-            self.prev_moves.pop()
+        self.unmake_move()
+        self.update_captures()
 
-        self.build_fen(self.all_board_positions[-1], False)
+    def unmake_move(self):
+        self.promo = False
+        if not self.undo_stack:
+            return
+
+        (
+            start,
+            end,
+            piece_start,
+            piece_end,
+            check,
+            enpas,
+            rights,
+            zobrist,
+            halfmove,
+        ) = self.undo_stack.pop()
+        self.prev_moves.pop()
+        self.key_history.pop()
+        self.cur_player ^= 1
+        if self.cur_player == 1:
+            self.fullmove -= 1
+
+        # if pawn was promoted, turn it back into a pawn before moving it back
+        if piece_start >> 1 == 0 and end >> 3 in (0, 7):
+            self.set_piece(end, piece_start)
+
+        self.move_piece(end, start)
+
+        if piece_end != 12:
+            self.set_piece(end, piece_end)
+        # if enpassant, restore the captured pawn
+        elif piece_start >> 1 == 0 and start & 7 != end & 7:
+            self.set_piece(end + (8 if self.cur_player == 0 else -8), piece_start ^ 1)
+        # if castling, move the rook back to its corner
+        elif piece_start >> 1 == 5 and abs(start - end) == 2:
+            if end > start:
+                self.move_piece(end - 1, 7 if self.cur_player else 63)
+            else:
+                self.move_piece(end + 1, 0 if self.cur_player else 56)
+
+        (
+            self.wrtc_king_side,
+            self.wrtc_queen_side,
+            self.brtc_king_side,
+            self.brtc_queen_side,
+        ) = rights
+        self.enpas = enpas
+        self.check = check
+        self.masks = None
+        self.zobrist = zobrist
+        self.halfmove = halfmove
+
+    # Passes the turn, the side to move must not be in check. The halfmove clock is
+    # reset so repetitions aren't looked for across the null move.
+    def make_null_move(self):
+        self.null_stack.append((self.enpas, self.zobrist, self.halfmove))
+        self.zobrist ^= self.enpas_key() ^ zobrist_white
+        self.enpas = None
+        self.halfmove = 0
+        self.cur_player ^= 1
+        self.masks = None
+        self.key_history.append(self.zobrist)
+
+    def unmake_null_move(self):
+        self.enpas, self.zobrist, self.halfmove = self.null_stack.pop()
+        self.cur_player ^= 1
+        self.masks = None
+        self.key_history.pop()
+
+    # Looks for the current position among earlier positions with the same side to
+    # move, going no further back than the last capture or pawn move
+    def is_repetition(self, count=1):
+        key = self.zobrist
+        history = self.key_history
+        last = len(history) - 1
+        found = 0
+        # a position can't repeat within the last four plies
+        for i in range(last - 4, max(last - self.halfmove, 0) - 1, -2):
+            if history[i] == key:
+                found += 1
+                if found >= count:
+                    return True
+        return False
 
     def get_enpas(self):
-        if self.prev_moves:
-            start, end = self.prev_moves[-1]
-            if (
-                (start >> 3, end >> 3) in [(1, 3), (6, 4)]
-                and abs(start - end) == 16
-                and self.board[end] >> 1 == 0
-            ):
-                return start + 8 if start >> 3 == 1 else start - 8
+        return self.enpas
 
     def board_to_fen(self):
         side = "wb"[self.cur_player]
@@ -196,10 +365,16 @@ class GameState:
         if empty != 0:
             board_fen += str(empty)
 
-        return f"{board_fen} {side} {rtc} {enpas}"
+        return f"{board_fen} {side} {rtc} {enpas} {self.halfmove} {self.fullmove}"
 
     def build_fen(self, fen, new=True):
         board_fen, side, rtc, enpas = fen.split()[:4]
+        clocks = fen.split()[4:6]
+        self.halfmove = int(clocks[0]) if clocks else 0
+        self.fullmove = int(clocks[1]) if len(clocks) > 1 else 1
+        self.zobrist = 0
+        self.mg, self.eg, self.game_phase = [0, 0], [0, 0], 0
+        self.piece_count, self.side_count, self.material = [0] * 12, [0, 0], 0
 
         for piece in self.wlocs:
             self.wlocs[piece] = []
@@ -212,16 +387,12 @@ class GameState:
             if char.isdigit():
                 fen_ind += int(char)
             elif char.isalpha():
-                piece = self.piece_to_num[char]
-                self.board[fen_ind] = piece
-                if piece & 1:
-                    self.blocs[piece].append(fen_ind)
-                else:
-                    self.wlocs[piece].append(fen_ind)
+                self.set_piece(fen_ind, self.piece_to_num[char])
                 fen_ind += 1
 
         self.update_captures()
         self.promo = False
+        self.masks = None
         self.cur_player = 0 if side == "w" else 1
         self.wrtc_king_side = "K" in rtc
         self.wrtc_queen_side = "Q" in rtc
@@ -235,15 +406,22 @@ class GameState:
             self.cur_player,
         )
 
+        self.enpas = None
         if enpas != "-":
             enpas_loc = self.parse_loc(enpas)
             start = enpas_loc + 8 if enpas[-1] == "3" else enpas_loc - 8
             end = enpas_loc - 8 if enpas[-1] == "3" else enpas_loc + 8
+            if self.board[end] >> 1 == 0:
+                self.enpas = enpas_loc
             if new:
                 self.prev_moves = [(start, end)]
 
+        self.zobrist = self.init_zobrist()
         if new:
             self.all_board_positions = [fen]
+            self.key_history = [self.zobrist]
+            self.undo_stack = []
+            self.null_stack = []
 
     def is_black_square(self, index):
         return ((index >> 3) + (index & 7)) & 1 == 1
@@ -275,21 +453,12 @@ class GameState:
 
     def insufficient(self):
         # Check for pawns, rooks, and queens
-        major_pieces = [0, 1, 6, 7, 8, 9]
-        if any(len(self.wlocs.get(piece, [])) > 0 for piece in major_pieces) or any(
-            len(self.blocs.get(piece, [])) > 0 for piece in major_pieces
-        ):
+        count = self.piece_count
+        if count[0] or count[1] or count[6] or count[7] or count[8] or count[9]:
             return False
 
         # Check for more than one minor piece
-        minor_pieces = [2, 3, 4, 5]
-        white_minor_pieces = sum(
-            len(self.wlocs.get(piece, [])) for piece in minor_pieces
-        )
-        black_minor_pieces = sum(
-            len(self.blocs.get(piece, [])) for piece in minor_pieces
-        )
-        if white_minor_pieces > 1 or black_minor_pieces > 1:
+        if count[2] + count[4] > 1 or count[3] + count[5] > 1:
             return False
 
         # Check for bishops of opposite colors
@@ -392,49 +561,76 @@ class GameState:
         ]
         return all(check(loc, side) for check in check_functions)
 
-    def test_king_safety(self, move):
+    # Checkers and pins of the side to move, computed once per position.
+    # check_mask holds the squares that stop a check (all squares if not in check,
+    # none if in double check) and pinned maps a pinned piece to the ray it can move on.
+    def get_masks(self):
+        if self.masks is not None:
+            return self.masks
+
         side = self.cur_player
         kloc = self.wlocs[10][0] if side == 0 else self.blocs[11][0]
-        start, end = move[0], move[1]
+        check_mask, checkers, pinned = 0, 0, {}
 
-        if not self.check:
-            vertical = start & 7 == kloc & 7
-            horizontal = start >> 3 == kloc >> 3
-            diag = abs((start >> 3) - (kloc >> 3)) == abs((start & 7) - (kloc & 7))
+        for off in [10, -10, 6, -6, 17, -17, 15, -15]:
+            loc = kloc + off
+            if self.on_board(off, kloc, loc) and self.board[loc] == 2 + side ^ 1:
+                check_mask |= 1 << loc
+                checkers += 1
+
+        for off in [-7, -9] if side == 0 else [7, 9]:
+            loc = kloc + off
+            if self.on_board(off, kloc, loc) and self.board[loc] == side ^ 1:
+                check_mask |= 1 << loc
+                checkers += 1
+
+        for off in [1, -1, 8, -8, 9, -9, 7, -7]:
+            attacking_pieces = (
+                [6 + side ^ 1, 8 + side ^ 1]  # Rook and Queen
+                if off in (1, -1, 8, -8)
+                else [4 + side ^ 1, 8 + side ^ 1]  # Bishop and Queen
+            )
+            ray, ally = 0, None
+            loc = kloc + off
+            while self.on_board(off, loc - off, loc):
+                piece = self.board[loc]
+                ray |= 1 << loc
+                if piece != 12:
+                    if piece & 1 == side:
+                        if ally is not None:
+                            break
+                        ally = loc
+                    else:
+                        if piece in attacking_pieces:
+                            if ally is None:
+                                check_mask |= ray
+                                checkers += 1
+                            else:
+                                pinned[ally] = ray
+                        break
+                loc += off
 
-            if not (vertical or horizontal or diag):
-                return True
+        if checkers == 0:
+            check_mask = all_squares
+        elif checkers > 1:
+            check_mask = 0
 
-            piece_start = self.board[start]
-            if piece_start >> 1 != 1:
-                if (vertical and end & 7 == kloc & 7) or (
-                    horizontal and end >> 3 == kloc >> 3
-                ):
-                    return True
+        self.masks = (check_mask, pinned)
+        return self.masks
 
-                if (
-                    diag
-                    and abs((start >> 3) - (end >> 3)) == abs((start & 7) - (end & 7))
-                    and abs((end >> 3) - (kloc >> 3)) == abs((end & 7) - (kloc & 7))
-                ):
-                    return True
+    # Plays the move out on the board to see if the king is left in check, only
+    # needed for enpassant where two pieces leave the same rank
+    def test_king_safety(self, move):
+        side = self.cur_player
+        kloc = self.wlocs[10][0] if side == 0 else self.blocs[11][0]
+        start, end = move[0], move[1]
+        cap = end + 8 if side == 0 else end - 8
 
-            self.board[start] = 12
-            king_safe = (
-                self.check_vertical_attacks(kloc, side)
-                if vertical
-                else self.check_horizontal_attacks(kloc, side)
-                if horizontal
-                else self.check_diagonal_attacks(kloc, side)
-            )
-            self.board[start] = piece_start
-            return king_safe
-        else:
-            piece_start, piece_end = self.board[start], self.board[end]
-            self.board[start], self.board[end] = 12, piece_start
-            king_safe = self.king_safe(kloc, side)
-            self.board[start], self.board[end] = piece_start, piece_end
-            return king_safe
+        piece_start, piece_end, piece_cap = self.board[start], self.board[end], self.board[cap]
+        self.board[start], self.board[end], self.board[cap] = 12, piece_start, 12
+        king_safe = self.king_safe(kloc, side)
+        self.board[start], self.board[end], self.board[cap] = piece_start, piece_end, piece_cap
+        return king_safe
 
     # A check function to ensure piece hasen't traversed the border
     def on_board(self, offset, start, end):
@@ -455,22 +651,28 @@ class GameState:
 
         return True
 
-    def generate_moves(self, start, test=False):
+    def generate_moves(self, start, test=False, quiet=False):
         piece = self.board[start]
         piece_value = piece >> 1
         piece_color = piece & 1
         end = start
-        safe = False
         moves = []
 
+        # Squares a non-king piece can move to without leaving the ally king in check
+        check_mask, pinned = self.get_masks()
+        allowed = check_mask & pinned[start] if start in pinned else check_mask
+        if not allowed and piece_value not in (0, 5):
+            return moves
+
         # Generate all pseudo-legal moves for the piece
         for off in self.offsets_map[piece_value]:
             off = -off if piece == 0 else off
             end = start + off
-            safe = safe if piece_value == 1 else False
 
-            # If piece is pawn
+            # If piece is pawn, promotions and captures aren't quiet
             if piece_value == 0:
+                if quiet and (off & 7 or end >> 3 in (0, 7)):
+                    continue
                 if self.on_board(off, start, end):
                     piece_end = self.board[end]
                     if (off in (8, -8) and piece_end != 12) or (
@@ -480,30 +682,37 @@ class GameState:
                     ):
                         continue
 
-                    if self.test_king_safety((start, end)):
+                    # If enpassant, both pawns leave the board so play it out
+                    if off & 7 and piece_end == 12:
+                        legal = self.test_king_safety((start, end))
+                    else:
+                        legal = allowed >> end & 1
+
+                    if legal:
                         if test:
                             return True
                         # If pawn promoting
                         if end >> 3 in (0, 7):
                             moves += [(start, end + (i << 2)) for i in range(1, 5)]
-                        # If pawn on home rank
-                        elif not off & 7 and start >> 3 == (6 if piece == 0 else 1):
-                            safe = not self.check
-                            moves.append((start, end))
-                            if self.board[end + off] == 12 and (
-                                safe or self.test_king_safety((start, end + off))
-                            ):
-                                if test:
-                                    return True
-                                moves.append((start, end + off))
                         else:
                             moves.append((start, end))
 
+                    # If pawn on home rank
+                    if (
+                        not off & 7
+                        and start >> 3 == (6 if piece == 0 else 1)
+                        and self.board[end + off] == 12
+                        and allowed >> (end + off) & 1
+                    ):
+                        if test:
+                            return True
+                        moves.append((start, end + off))
+
             # If piece is king
             elif piece_value == 5:
                 if self.on_board(off, start, end):
                     piece_end = self.board[end]
-                    if piece_end != 12 and piece_end & 1 == piece_color:
+                    if piece_end != 12 and (quiet or piece_end & 1 == piece_color):
                         continue
                     if self.king_safe(end, piece_color):
                         if test:
@@ -533,45 +742,149 @@ class GameState:
 
             # If piece is queen, rook, bishop or knight
             else:
-                tried = False
                 while self.on_board(off, start, end):
                     piece_end = self.board[end]
 
                     # If we encounter another piece of the same color, stop
-                    if piece_end != 12 and piece_end & 1 == piece_color:
+                    if piece_end != 12 and (quiet or piece_end & 1 == piece_color):
                         break
 
-                    tried = True
                     # If move doesn't result in ally king being in check
-                    if safe or self.test_king_safety((start, end)):
+                    if allowed >> end & 1:
                         if test:
                             return True
-                        safe = not self.check
                         moves.append((start, end))
 
                     # If end square is not empty or start piece is knight, break.
-                    if (
-                        piece_end != 12
-                        or (not safe and not self.check)
-                        or piece_value == 1
-                    ):
+                    if piece_end != 12 or piece_value == 1:
                         break
                     end += off
+        return moves
+
+    # Squares of the pieces of side attacking loc
+    def attacker_locs(self, loc, side):
+        locs = []
+
+        for off in [7, 9] if side == 0 else [-7, -9]:
+            new_loc = loc + off
+            if self.on_board(off, loc, new_loc) and self.board[new_loc] == side:
+                locs.append(new_loc)
 
-                # If knight is pinned, stop
-                if piece_value == 1 and tried and not safe and not self.check:
+        for off in [10, -10, 6, -6, 17, -17, 15, -15]:
+            new_loc = loc + off
+            if self.on_board(off, loc, new_loc) and self.board[new_loc] == 2 + side:
+                locs.append(new_loc)
+
+        for off in [1, -1, 8, -8, 9, -9, 7, -7]:
+            attacking_pieces = (
+                [6 + side, 8 + side]  # Rook and Queen
+                if off in (1, -1, 8, -8)
+                else [4 + side, 8 + side]  # Bishop and Queen
+            )
+            new_loc = loc + off
+            while self.on_board(off, new_loc - off, new_loc):
+                piece = self.board[new_loc]
+                if piece != 12:
+                    if piece in attacking_pieces or (
+                        new_loc == loc + off and piece == 10 + side
+                    ):  # or king and one square away
+                        locs.append(new_loc)
                     break
+                new_loc += off
+
+        return locs
+
+    # Captures and promotions of the side to move. Captures are found by looking
+    # outwards from the enemy pieces, so empty squares are never visited.
+    def generate_noisy_moves(self):
+        side = self.cur_player
+        check_mask, pinned = self.get_masks()
+        kloc = self.wlocs[10][0] if side == 0 else self.blocs[11][0]
+        enemy_locs = self.blocs if side == 0 else self.wlocs
+        moves = []
+
+        for piece in enemy_locs:
+            if piece >> 1 == 5:
+                continue
+            for end in enemy_locs[piece]:
+                for start in self.attacker_locs(end, side):
+                    if start == kloc:
+                        if self.king_safe(end, side):
+                            moves.append((start, end))
+                    elif (check_mask & pinned[start] if start in pinned else check_mask) >> end & 1:
+                        # If pawn promoting
+                        if end >> 3 in (0, 7) and self.board[start] >> 1 == 0:
+                            moves += [(start, end + (i << 2)) for i in range(1, 5)]
+                        else:
+                            moves.append((start, end))
+
+        # If enpassant
+        enpas = self.enpas
+        if enpas is not None:
+            for start in (enpas + 7, enpas + 9) if side == 0 else (enpas - 7, enpas - 9):
+                if (
+                    self.board[start] == side
+                    and abs((start & 7) - (enpas & 7)) == 1
+                    and self.test_king_safety((start, enpas))
+                ):
+                    moves.append((start, enpas))
+
+        # If pawn pushing onto the last rank
+        off = 8 if side else -8
+        for start in self.blocs[1] if side else self.wlocs[0]:
+            end = start + off
+            if (
+                end >> 3 in (0, 7)
+                and self.board[end] == 12
+                and (check_mask & pinned[start] if start in pinned else check_mask) >> end & 1
+            ):
+                moves += [(start, end + (i << 2)) for i in range(1, 5)]
+
         return moves
 
-    def move(self, move):
+    # Non-capturing, non-promoting moves of the side to move, castling included
+    def generate_quiet_moves(self):
+        moves = []
+        for starts in (self.blocs if self.cur_player else self.wlocs).values():
+            for start in starts:
+                moves += self.generate_moves(start, quiet=True)
+        return moves
+
+    # Search-mode move, terminal states are left for the search to detect
+    def make_move(self, move):
         start = move[0]
         self.promo = True if self.promo_move(start) else False
         end = move[1] if not self.promo else self.parse_promo(start, move[1])[0]
 
         piece_start = self.board[start]
         piece_end = self.board[end]
+        rights = (
+            self.wrtc_king_side,
+            self.wrtc_queen_side,
+            self.brtc_king_side,
+            self.brtc_queen_side,
+        )
+
+        # undo record: everything that can't be recomputed when taking the move back
+        self.undo_stack.append(
+            (
+                start,
+                end,
+                piece_start,
+                piece_end,
+                self.check,
+                self.enpas,
+                rights,
+                self.zobrist,
+                self.halfmove,
+            )
+        )
+        self.halfmove = 0 if piece_start >> 1 == 0 or piece_end != 12 else self.halfmove + 1
+        self.fullmove += self.cur_player
 
+        self.zobrist ^= self.enpas_key()
         self.check = False
+        self.enpas = None
         self.move_piece(start, end)
 
         self.prev_moves.append(move)
@@ -587,6 +900,9 @@ class GameState:
             # if enpassant
             elif piece_end == 12 and start & 7 != end & 7:
                 self.set_piece(end + off, 12)
+            # if double push, mark the skipped square
+            elif abs(start - end) == 16:
+                self.enpas = (start + end) >> 1
 
         # if piece is king
         elif piece_start >> 1 == 5:
@@ -602,30 +918,43 @@ class GameState:
                     else:
                         self.move_piece(7 if self.cur_player else 63, end + path)
 
-        # if piece is rook
-        rook_loc = (
-            start if piece_start >> 1 == 3 else end if piece_end >> 1 == 3 else None
-        )
-        if rook_loc is not None:
-            rook_castling_map = {
-                63: "wrtc_king_side",
-                56: "wrtc_queen_side",
-                7: "brtc_king_side",
-                0: "brtc_queen_side",
-            }
+        # a move from or onto a rook's home corner loses that rook's right, also when
+        # a rook captures the other side's rook there
+        rook_castling_map = {
+            63: "wrtc_king_side",
+            56: "wrtc_queen_side",
+            7: "brtc_king_side",
+            0: "brtc_queen_side",
+        }
+        for rook_loc in (start, end):
             if rook_loc in rook_castling_map:
                 setattr(self, rook_castling_map[rook_loc], False)
 
-        if piece_end != 12:
-            self.update_captures()
-
         self.cur_player ^= 1
+        self.masks = None
 
         locs = self.wlocs if self.cur_player == 0 else self.blocs
         if not self.king_safe(locs[10 + self.cur_player][0], self.cur_player):
             self.check = True
 
+        rtc = (
+            self.wrtc_king_side,
+            self.wrtc_queen_side,
+            self.brtc_king_side,
+            self.brtc_queen_side,
+        )
+        if rtc != rights:
+            for i in range(4):
+                if rtc[i] != rights[i]:
+                    self.zobrist ^= zobrist_castling[i]
+
+        self.zobrist ^= zobrist_white ^ self.enpas_key()
+        self.key_history.append(self.zobrist)
+
+    def move(self, move):
+        self.make_move(move)
+        self.update_captures()
         self.check_mate()
         fen = self.board_to_fen()
         self.all_board_positions.append(fen)
-        self.draw = self.all_board_positions.count(fen) > 2 or self.insufficient()
+        self.draw = self.is_repetition(2) or self.halfmove >= 100 or self.insufficient()
@@ -1,83 +1,192 @@
-from collections import defaultdict
-import os, time, mmap, chess, chess.syzygy, chess.polyglot
+from array import array
+from multiprocessing import shared_memory
+import os, time, random, traceback, chess, chess.syzygy, chess.polyglot
 from pesto import *
 from board import *
+from bitboard import *
 from tt import *
 
 INFINITY = 15000
 MATESCORE = 14500
 CHECKMATE = 14000
 
-history_table = defaultdict(lambda: {"killer": 0, "freq": 0})
-counter_move_table = defaultdict(list)
-killer_table = defaultdict(list)
 guess = (0,None)
-pvals = [88, 309, 331, 495, 981, 10000, 0]
 fmargins = [200, 300, 500, 1000]
 current_dir = os.path.dirname(os.path.abspath(__file__))
 syzygy_path = os.path.join(current_dir, "syzygy 3-4")
 egtb = chess.syzygy.open_tablebase(syzygy_path) # endgame tablebase <= 4 pieces
-
-def hash(gs):
-    h = 0
-    for i in range(64):
-        piece = gs.board[i]
-        if piece != 12:
-            h ^= gs.zobrist_table[i][piece] 
-
-    if gs.cur_player:
-        h ^= gs.zobrist_table[-1]  
-
-    rtc = [gs.wrtc_king_side, gs.wrtc_queen_side, gs.brtc_king_side, gs.brtc_queen_side]
-    for i in range(len(rtc)):
-        if rtc[i]:
-            h ^= gs.zobrist_table[-2 - i]
-
-    enpas = gs.get_enpas()
-    if enpas:
-        h ^= gs.zobrist_table[-6 - (enpas & 7)]
-
-    return h
+backends = {"mailbox": GameState, "bitboard": BitboardGameState}
+
+# Transposition table in anonymous shared memory, created by uci.py and attached
+# once by every search process. The SharedMemory object has to outlive the buffer.
+tt_shm, trans_table = None, None
+
+# Nodes searched by this process, published to its slot of the table now and then,
+# and the time.time() the current search has to stop at, 0 when it has no time limit
+nodes, node_slot, deadline = 0, 0, 0
+start_time, soft_time, hard_time, pondering = 0, 0, 0, False
+book = None # opening book, opened by the first search of the process
+
+# Time limits of the current search in seconds, set by uci.py in the table. A
+# pondering search has none until ponderhit gives it the limits for the move.
+def read_limits():
+    global start_time, soft_time, hard_time, deadline, pondering
+    pondering = get_ponder(trans_table)
+    start_time = get_time(trans_table, "start") / 1000
+    hard_time, soft_time = get_time(trans_table, "max") / 1000, get_time(trans_table, "soft") / 1000
+    deadline = start_time + hard_time if hard_time else 0
+
+# The clock is polled every 64 nodes instead of at every node
+def count_node(trans_table):
+    global nodes
+    nodes += 1
+    if not nodes & 63:
+        if pondering and not get_ponder(trans_table):
+            read_limits()
+        if deadline and time.time() > deadline:
+            trans_table[-1] = 1
+        if not nodes & 1023:
+            set_nodes(trans_table, node_slot, nodes)
+
+def attach_tt(name):
+    global tt_shm, trans_table
+    tt_shm = shared_memory.SharedMemory(name=name)
+    trans_table = tt_shm.buf
+
+# Evaluation cache, always replace and local to each search process, allocated by
+# its first search. Keys and scores are kept in flat arrays, 12 bytes per entry.
+# eval_stats holds the probes and hits since the start of the current search.
+eval_hash_mb = 16
+eval_keys, eval_scores = array("Q"), array("i")
+eval_stats = [0, 0]
+
+def resize_eval_cache(mb):
+    global eval_hash_mb, eval_keys, eval_scores
+    entries = (mb << 20) // 12
+    eval_hash_mb = mb
+    eval_keys, eval_scores = array("Q", bytes(entries * 8)), array("i", bytes(entries * 4))
+
+def evaluate(gs):
+    if not eval_keys:
+        return pesto(gs)
+    key = gs.zobrist
+    ind = key % len(eval_keys)
+    eval_stats[0] += 1
+    if eval_keys[ind] == key:
+        eval_stats[1] += 1
+        return eval_scores[ind]
+    score = pesto(gs)
+    eval_keys[ind], eval_scores[ind] = key, score
+    return score
 
 def material_left(gs, side = -1):
-    count = 0
-    locs = [gs.wlocs, gs.blocs]
-    locs = [locs[side]] if side > -1 else locs
-    for loc in locs:
-        for piece in loc:
-            count += len(loc[piece])
-    return count
+    return gs.side_count[side] if side > -1 else gs.side_count[0] + gs.side_count[1]
 
 def material_balance(gs):
-    locs = [gs.wlocs, gs.blocs]
-    bal = 0
-    for piece in locs[gs.cur_player]:
-        bal += pvals[piece >> 1]*(len(locs[gs.cur_player][piece]) - len(locs[gs.cur_player^1][((piece >> 1) << 1) + gs.cur_player^1]))
-    return bal
+    return -gs.material if gs.cur_player else gs.material
+
+# Capture scores indexed [victim][attacker], most valuable victim first and the least
+# valuable attacker first among equal victims
+mvv_lva_table = [
+    [pvals[victim >> 1] * 8 - (attacker >> 1) for attacker in range(12)]
+    for victim in range(12)
+]
+
+# Move ordering tables of fixed size. History and counter moves are indexed
+# [side][from][to] with 7 bits for to, as promotions are encoded above square 63,
+# and hold moves packed as from << 7 | to, 0 being no move. Killers are indexed by
+# the ply from the search root, three per ply with the newest last.
+max_ply = 128
+max_moves = 256
+history_cutoffs = array("q", bytes(8 << 14))
+history_tries = array("q", bytes(8 << 14))
+counter_move_table = array("H", bytes(2 << 14))
+killer_table = array("H", bytes(2 * 3 * max_ply))
+root_ply = 0
+
+def move_index(move, side):
+    return side << 13 | move[0] << 7 | move[1]
+
+def search_ply(gs):
+    return len(gs.undo_stack) + len(gs.null_stack) - root_ply
+
+# Halves the history between searches so old cutoffs fade, killers belong to the
+# previous search's plies and are dropped
+def age_history():
+    for i in range(len(history_cutoffs)):
+        history_cutoffs[i] >>= 1
+        history_tries[i] >>= 1
+    for i in range(len(killer_table)):
+        killer_table[i] = 0
+
+def get_killers(gs):
+    ply = search_ply(gs)
+    if ply >= max_ply:
+        return []
+    return [(code >> 7, code & 127) for code in killer_table[ply * 3:ply * 3 + 3] if code]
+
+def get_counter(gs):
+    if not gs.prev_moves:
+        return None
+    code = counter_move_table[move_index(gs.prev_moves[-1], gs.cur_player ^ 1)]
+    return (code >> 7, code & 127) if code else None
+
+# Records a quiet move that caused a beta cutoff
+def store_cutoff(gs, move, depth):
+    side = gs.cur_player
+    code = move[0] << 7 | move[1]
+    ply = search_ply(gs)
+    if ply < max_ply and code not in killer_table[ply * 3:ply * 3 + 3]:
+        killer_table[ply * 3:ply * 3 + 3] = array("H", [killer_table[ply * 3 + 1], killer_table[ply * 3 + 2], code])
+    history_cutoffs[move_index(move, side)] += 1 << min(depth, 32)
+    if gs.prev_moves:
+        counter_move_table[move_index(gs.prev_moves[-1], side ^ 1)] = code
+
+# Move scores are written into a buffer per ply, reused by every node at that ply
+score_buffers = [[0] * max_moves for _ in range(max_ply)]
+
+def ply_scores(gs):
+    ply = search_ply(gs)
+    while len(score_buffers) <= ply:
+        score_buffers.append([0] * max_moves)
+    return score_buffers[ply]
+
+# Yields moves best score first, each step selects the best of the remaining moves
+# so nothing is sorted past a cutoff
+def pick_moves(moves, scores):
+    n = len(moves)
+    for i in range(n):
+        best = i
+        for j in range(i + 1, n):
+            if scores[j] > scores[best]:
+                best = j
+        if best != i:
+            moves[i], moves[best] = moves[best], moves[i]
+            scores[i], scores[best] = scores[best], scores[i]
+        yield moves[i]
+
+def score_captures(gs, moves, scores):
+    board = gs.board
+    for i, (start, end) in enumerate(moves):
+        scores[i] = mvv_lva_table[board[end]][board[start]]
 
 def mvv_lva(gs, moves):
-    victim_to_attackers = defaultdict(list)
-
-    for attacker, victim in moves:
-        victim_to_attackers[victim].append(attacker)
+    scores = ply_scores(gs)
+    score_captures(gs, moves, scores)
+    return list(pick_moves(moves, scores))
 
-    sorted_moves = [
-        (attacker, victim)
-        for victim in sorted(
-            victim_to_attackers.keys(), key=lambda v: gs.board[v], reverse=True
-        )
-        for attacker in victim_to_attackers[victim]
-    ]
-    return sorted_moves
+def history_score(move, side):
+    ind = move_index(move, side)
+    return history_cutoffs[ind] * 10000 // max(1, history_tries[ind])
 
-def order_moves(gs, moves, depth = None):
+def order_moves(gs, moves):
     promo_moves, capture_moves, check_moves, quiet_moves = [], [], [], []
-    history_rel = defaultdict(lambda: 0)
-    killer_moves = killer_table[depth]
-    promo_ranks = (5, 6) if gs.cur_player else (1, 2)
+    killer_moves = get_killers(gs)
+    side = gs.cur_player
+    counter = get_counter(gs)
 
     for start, end in moves:
-        if start//8 in promo_ranks and gs.board[start] >> 1 == 0:
+        if gs.promo_move(start):
             promo_moves.append((start, end))
         elif gs.board[end] != 12:
             capture_moves.append((start, end))
@@ -88,19 +197,101 @@ def order_moves(gs, moves, depth = None):
 
     capture_moves = mvv_lva(gs, capture_moves)
 
-    for move in quiet_moves:
+    scores = ply_scores(gs)
+    for i, move in enumerate(quiet_moves):
         if move in killer_moves:
-            history_rel[move] = 1.1 + killer_moves.index(move)
+            scores[i] = 11000 + 10000 * killer_moves.index(move)
         else:
-            kill_freq = history_table[move, gs.cur_player]
-            cm = 0.075 if gs.prev_moves and gs.prev_moves[-1] == counter_move_table[move, gs.cur_player] else 0
-            history_rel[move] = (kill_freq["killer"] / max(1, kill_freq["freq"])) + cm
-    quiet_moves.sort(key=lambda move: history_rel.get(move, 0), reverse=True)
+            scores[i] = history_score(move, side) + (750 if move == counter else 0)
+    quiet_moves = list(pick_moves(quiet_moves, scores))
 
     noisy_moves_len = len(promo_moves) + len(capture_moves) + len(check_moves)
 
     return promo_moves + capture_moves + check_moves + quiet_moves, noisy_moves_len
 
+# Yields moves in stages so most of the ordering work is skipped at cut nodes:
+# hash move, promotions and winning captures, killers and counter move, the remaining
+# quiet moves by history and finally losing captures. Moves come with a quiet flag.
+class MovePicker:
+    def __init__(self, gs, tt_move=None):
+        self.gs = gs
+        self.tt_move = tt_move if tt_move not in (None, (0, 0), (1, 1)) else None
+
+        # evasions are few, generate them upfront so the count is known for extensions
+        self.moves = get_valid_moves(gs) if gs.check else None
+        self.count = len(self.moves) if gs.check else None
+
+    def is_valid(self, move, quiet=False):
+        if self.moves is not None:
+            return move in self.moves
+        piece = self.gs.board[move[0]]
+        return piece != 12 and piece & 1 == self.gs.cur_player and move in self.gs.generate_moves(move[0], quiet=quiet)
+
+    def is_enpas(self, move):
+        return move[1] == self.gs.enpas and self.gs.board[move[0]] >> 1 == 0
+
+    def is_quiet(self, move):
+        return not self.gs.promo_move(move[0]) and self.gs.board[move[1]] == 12 and not self.is_enpas(move)
+
+    def __iter__(self):
+        gs = self.gs
+        side = gs.cur_player
+        tt_move = self.tt_move
+
+        if tt_move and self.is_valid(tt_move):
+            yield tt_move, self.is_quiet(tt_move)
+        else:
+            tt_move = None
+
+        # in check all evasions are at hand, otherwise only captures and promotions
+        # are generated here and the quiet moves are left until they are needed
+        moves = self.moves if self.moves is not None else gs.generate_noisy_moves()
+        promo_moves, capture_moves, quiet_moves, bad_captures = [], [], [], []
+        for move in moves:
+            if move == tt_move:
+                continue
+            # en passant goes with the promotions, MVV-LVA and SEE look at the end square
+            if gs.promo_move(move[0]) or self.is_enpas(move):
+                promo_moves.append(move)
+            elif gs.board[move[1]] != 12:
+                capture_moves.append(move)
+            else:
+                quiet_moves.append(move)
+
+        for move in promo_moves:
+            yield move, False
+
+        scores = ply_scores(gs)
+        score_captures(gs, capture_moves, scores)
+        for move in pick_moves(capture_moves, scores):
+            start, end = move
+            if pvals[gs.board[end] >> 1] < pvals[gs.board[start] >> 1] and not see_ge(gs, move):
+                bad_captures.append(move)
+                continue
+            yield move, False
+
+        killers = get_killers(gs)[::-1]
+        counter = get_counter(gs)
+        played = [tt_move]
+        for move in killers + [counter]:
+            if not move or move in played or not self.is_valid(move, quiet=True) or not self.is_quiet(move):
+                continue
+            played.append(move)
+            yield move, True
+
+        if self.moves is None:
+            quiet_moves = gs.generate_quiet_moves()
+        quiet_moves = [move for move in quiet_moves if move not in played]
+
+        for i, move in enumerate(quiet_moves):
+            scores[i] = history_score(move, side)
+
+        for move in pick_moves(quiet_moves, scores):
+            yield move, True
+
+        for move in bad_captures:
+            yield move, False
+
 def get_valid_moves(gs):
     valid_moves = []
     locs = gs.wlocs if gs.cur_player == 0 else gs.blocs
@@ -111,32 +302,42 @@ def get_valid_moves(gs):
 
     return valid_moves
 
+# Number of leaf nodes of the legal move tree, moves at the last ply are counted not played
+def perft(gs, depth):
+    moves = get_valid_moves(gs)
+    if depth <= 1:
+        return len(moves) if depth == 1 else 1
+
+    nodes = 0
+    for move in moves:
+        gs.make_move(move)
+        nodes += perft(gs, depth - 1)
+        gs.unmake_move()
+    return nodes
+
+# Perft split by root move
+def perft_divide(gs, depth):
+    counts = []
+    for move in get_valid_moves(gs):
+        gs.make_move(move)
+        counts.append((move, perft(gs, depth - 1)))
+        gs.unmake_move()
+    return counts
+
+# Moves for quiescence, captures come first in MVV-LVA order followed by the moves
+# that are always searched (promotions, en passant and, in check, the other evasions)
 def get_noisy_moves(gs):
-    if gs.check:
-        return get_valid_moves(gs)
-    
-    promo_moves, capture_moves = [], []
-    locs = gs.wlocs if gs.cur_player == 0 else gs.blocs
-    promo_rank = 6 if gs.cur_player else 2
+    moves = get_valid_moves(gs) if gs.check else gs.generate_noisy_moves()
+    capture_moves, other_moves = [], []
 
-    for starts in locs.values():
-        for start in starts:
-            for move in gs.generate_moves(start):
-                start, end = move
-                if start//8 == promo_rank and gs.board[start] >> 1 == 0:
-                    promo_moves.append(move) 
-                elif gs.board[end] != 12:
-                    capture_moves.append(move)
-    
-    capture_moves = mvv_lva(gs, capture_moves)
-    return capture_moves + promo_moves
+    for move in moves:
+        if not gs.promo_move(move[0]) and gs.board[move[1]] != 12:
+            capture_moves.append(move)
+        else:
+            other_moves.append(move)
 
-def make_null_move(gs):
-    gs.cur_player ^= 1
-    fen_parts = gs.all_board_positions[-1].split(" ")
-    fen_parts[1] = 'b' if fen_parts[1] == 'w' else 'w'
-    fen = " ".join(fen_parts)
-    gs.all_board_positions[-1] = fen
+    capture_moves = mvv_lva(gs, capture_moves)
+    return capture_moves + other_moves, len(capture_moves)
 
 def move_is_check(gs, move):
     check = False
@@ -152,111 +353,145 @@ def move_is_check(gs, move):
     gs.board[end] = end_piece
     return check
 
-def get_smallest_attacker(gs, loc, side):
-    queen = None
-    king = None
-    king_safe = True
+# Attackers of loc for static exchange evaluation. Knights are kept per side, every
+# other attacker sits on one of the eight rays from loc, ordered by distance, with
+# the sliders behind it that join the exchange once it has captured (x-rays).
+def see_attackers(gs, loc):
+    board = gs.board
+    knights = [[], []]
+    rays = []
 
-    # check if pawn is attacking the square
-    offs = [7, 9] if side == 0 else [-7, -9]
-    for off in offs:
-        new_loc = loc + off
-        if gs.on_board(off, loc, new_loc) and gs.board[new_loc] == side:
-            return new_loc
-            
-    # Check if knight is attacking the square
     for off in [10, -10, 6, -6, 17, -17, 15, -15]:
         new_loc = loc + off
-        if gs.on_board(off, loc, new_loc):
-            piece = gs.board[new_loc]
-            if piece == 2 + side: # Knight
-                return new_loc
-            if piece == 2 + side ^ 1: # If knight defending
-                king_safe = False     # king can't capture
-    
-    # Check if square is attacked diagonally
-    for off in [9, -9, 7, -7]:
-        for new_loc in range(loc + off, -1 if off < 0 else 64, off):
-            if not gs.on_board(off, loc, new_loc):
-                break
-            piece = gs.board[new_loc]
-            if piece == 4 + side:
-                return new_loc
-            if piece == 8 + side:
-                queen = new_loc
-            elif piece == 10 + side and new_loc == loc + off:
-                king = new_loc
-            elif piece != 12:
-                if piece in [4 + side ^ 1, 8 + side ^ 1] or (piece == 10 + side ^ 1 and new_loc == loc + off):
-                    king_safe = False
-                break
+        if gs.on_board(off, loc, new_loc) and board[new_loc] >> 1 == 1:
+            knights[board[new_loc] & 1].append(new_loc)
 
-    # Check if square is attacked horizontally or vertically
-    for off in [8, -8, 1, -1]:
-        for new_loc in range(loc + off, -1 if off < 0 else 64, off):
-            if not gs.on_board(off, loc, new_loc):
-                break
-            piece = gs.board[new_loc]
-            if piece == 6 + side:
-                return new_loc
-            if piece == 8 + side:
-                queen = new_loc
-            elif piece == 10 + side and new_loc == loc + off:
-                king = new_loc
-            elif piece != 12:
-                if piece in [6 + side ^ 1, 8 + side ^ 1] or (piece == 10 + side ^ 1 and new_loc == loc + off):
-                    king_safe = False
-                break
+    for off in [8, -8, 1, -1, 9, -9, 7, -7]:
+        slider = 3 if off in (8, -8, 1, -1) else 2 # Rook or Bishop
+        ray = []
+        new_loc = loc + off
+        while gs.on_board(off, new_loc - off, new_loc):
+            piece = board[new_loc]
+            if piece != 12:
+                if piece >> 1 in (slider, 4):
+                    ray.append(new_loc)
+                # King and pawns only attack from next to loc
+                elif new_loc == loc + off and (
+                    piece >> 1 == 5 or (slider == 2 and piece == (0 if off > 0 else 1))
+                ):
+                    ray.append(new_loc)
+                else:
+                    break
+            new_loc += off
+        if ray:
+            ray.reverse()
+            rays.append(ray)
+
+    return knights, rays
+
+# Takes the least valuable attacker of side out of the exchange, None if there is none
+def see_pop(gs, knights, rays, side):
+    board = gs.board
+    best, best_ray = None, None
+    if knights[side]:
+        best = knights[side][-1]
+    for ray in rays:
+        loc = ray[-1]
+        if board[loc] & 1 == side and (best is None or board[loc] < board[best]):
+            best, best_ray = loc, ray
+    if best_ray:
+        best_ray.pop()
+        if not best_ray:
+            rays.remove(best_ray)
+    elif best is not None:
+        knights[side].pop()
+    return best
+
+def see_remove(knights, rays, loc):
+    if loc in knights[0]:
+        knights[0].remove(loc)
+    elif loc in knights[1]:
+        knights[1].remove(loc)
+    for ray in rays:
+        if ray[-1] == loc:
+            ray.pop()
+            if not ray:
+                rays.remove(ray)
+            break
 
-    if queen:
-        return queen
+def has_attacker(gs, knights, rays, side):
+    return bool(knights[side]) or any(gs.board[ray[-1]] & 1 == side for ray in rays)
 
-    # Check if pawn is defending the square
-    offs = [7, 9] if side == 1 else [-7, -9]
-    for off in offs:
-        new_loc = loc + off
-        if gs.on_board(off, loc, new_loc) and gs.board[new_loc] == side ^ 1:
-            king_safe = False
-
-    return king if king_safe else None
-
-def see(gs, loc, side):
-    value = 0
-    attacker = get_smallest_attacker(gs, loc, side)
-    attacker_piece = gs.board[attacker] if attacker else None
-    victim_piece = gs.board[loc]
-    if attacker:
-        gs.board[attacker] = 12
-        gs.board[loc] = attacker_piece
-        value = max(0, pvals[victim_piece >> 1] - see(gs, loc, side ^ 1))
-        gs.board[loc] = victim_piece
-        gs.board[attacker] = attacker_piece
-    return value
-
-def see_capture(gs, start, end, side):
-    value = 0
-    start_piece = gs.board[start]
-    end_piece = gs.board[end]
-    gs.board[start] = 12
-    gs.board[end] = start_piece
-    value = pvals[end_piece >> 1] - see(gs, end, side ^ 1)
-    gs.board[start] = start_piece
-    gs.board[end] = end_piece
-    return value
+# Material won by the side playing move, once all profitable recaptures on the end
+# square have been made, resolved with a swap list instead of recursion
+def see(gs, move):
+    start, end = move
+    board = gs.board
+    knights, rays = see_attackers(gs, end)
+    see_remove(knights, rays, start)
+
+    gain = [pvals[board[end] >> 1]]
+    piece = board[start]
+    side = piece & 1 ^ 1
+    while True:
+        loc = see_pop(gs, knights, rays, side)
+        if loc is None:
+            break
+        # the king can only recapture if nothing else defends the square
+        if board[loc] >> 1 == 5 and has_attacker(gs, knights, rays, side ^ 1):
+            break
+        gain.append(pvals[piece >> 1] - gain[-1])
+        piece = board[loc]
+        side ^= 1
 
-def quiesce(gs, alpha, beta, trans_table, depth = 0):
-    if round(time.time()*1000) - get_time(trans_table, "start") > get_time(trans_table, "max") * 0.99:
-        trans_table[-1] = 1
+    for i in range(len(gain) - 1, 0, -1):
+        gain[i - 1] = -max(-gain[i - 1], gain[i])
+    return gain[0]
+
+# Whether see(gs, move) >= margin, stops as soon as the outcome is settled
+def see_ge(gs, move, margin=0):
+    start, end = move
+    board = gs.board
+    swap = pvals[board[end] >> 1] - margin
+    if swap < 0:
+        return False
+    swap = pvals[board[start] >> 1] - swap
+    if swap <= 0:
+        return True
+
+    knights, rays = see_attackers(gs, end)
+    see_remove(knights, rays, start)
+    side = board[start] & 1
+    result = True
+    while True:
+        side ^= 1
+        loc = see_pop(gs, knights, rays, side)
+        if loc is None:
+            break
+        # the king can only recapture if nothing else defends the square
+        if board[loc] >> 1 == 5:
+            return result if has_attacker(gs, knights, rays, side ^ 1) else not result
+        result = not result
+        swap = pvals[board[loc] >> 1] - swap
+        if swap < result:
+            break
+    return result
 
+def quiesce(gs, alpha, beta, trans_table, depth = 0):
     if trans_table[-1] == 0:
-        node_count(trans_table, "add")
-        if gs.checkmate:
-            return -MATESCORE + depth
-        elif gs.stalemate or gs.draw:
+        count_node(trans_table)
+        if gs.halfmove >= 100 or gs.is_repetition(2) or gs.insufficient():
             return 0
+
+        # stalemate is left undetected in quiescence, only mates are scored. Out of
+        # check the moves are generated once the node survives the stand pat cutoffs.
+        if gs.check:
+            noisy_moves, captures_len = get_noisy_moves(gs)
+            if not noisy_moves:
+                return -MATESCORE + depth
         
         alpha_og = alpha
-        zobrist = hash(gs)
+        zobrist = gs.zobrist
         tt_entry = get_tt(trans_table, zobrist)
 
         if tt_entry and tt_entry[-1] == (1, 1):
@@ -274,7 +509,7 @@ def quiesce(gs, alpha, beta, trans_table, depth = 0):
             if alpha >= beta:
                 return tt_score
                              
-        stand_pat = pesto(gs)
+        stand_pat = evaluate(gs)
 
         if stand_pat >= beta and not gs.check:
             return beta
@@ -287,21 +522,21 @@ def quiesce(gs, alpha, beta, trans_table, depth = 0):
         if stand_pat > alpha:
             alpha = stand_pat    
 
-        for move in get_noisy_moves(gs):
-            start = move[0]
-            end = move[1] if not gs.promo_move(start) else gs.parse_promo(start, move[1])[0]
-            piece_end = gs.board[end]
+        if not gs.check:
+            noisy_moves, captures_len = get_noisy_moves(gs)
 
-            if (
-                piece_end != 12 and 
-                (stand_pat + pvals[piece_end >> 1] + fmargins[0] <= alpha or
-                see_capture(gs, start, end, gs.cur_player) < 0)
+        for m, move in enumerate(noisy_moves):
+            start, end = move
+
+            if m < captures_len and (
+                stand_pat + pvals[gs.board[end] >> 1] + fmargins[0] <= alpha or
+                not see_ge(gs, move)
             ):
                 continue
 
-            gs.move(move)
+            gs.make_move(move)
             score = -quiesce(gs, -beta, -alpha, trans_table, depth - 1)
-            gs.undo()
+            gs.unmake_move()
             alpha = max(alpha, score)
             if alpha >= beta:
                 break
@@ -325,16 +560,18 @@ def quiesce(gs, alpha, beta, trans_table, depth = 0):
     return alpha
 
 def negamax_root(gs, depth, alpha, beta, trans_table, moves = None, allow_null = True):    
+    global root_ply
     best_score = -INFINITY
     best_move = (0, 0)
+    root_ply = len(gs.undo_stack) + len(gs.null_stack)
 
     if trans_table[-1] == 0:
-        node_count(trans_table, "add")
+        count_node(trans_table)
         alpha_og = alpha
-        zobrist = hash(gs)
+        zobrist = gs.zobrist
         tt_entry = get_tt(trans_table, zobrist)
 
-        if gs.all_board_positions.count(gs.all_board_positions[-1]) < 2 and tt_entry:
+        if tt_entry and not gs.is_repetition():
             tt_score, tt_flag, tt_depth, tt_move = tt_entry
             if tt_depth >= depth and tt_move != (1, 1):
                 if tt_score < -CHECKMATE:
@@ -355,7 +592,8 @@ def negamax_root(gs, depth, alpha, beta, trans_table, moves = None, allow_null =
         valid_moves = get_valid_moves(gs) if not moves else moves
         noisy_moves_len = 0
         random.shuffle(valid_moves)
-        valid_moves, noisy_moves_len = order_moves(gs, valid_moves, depth)  
+        valid_moves, noisy_moves_len = order_moves(gs, valid_moves)  
+        searched = False
 
         for m, move in enumerate(valid_moves):
             if trans_table[-1] != 0:
@@ -367,7 +605,7 @@ def negamax_root(gs, depth, alpha, beta, trans_table, moves = None, allow_null =
             end_square = move[1] if not promo_move else gs.parse_promo(start_square, move[1])[0]
             end_piece = gs.board[end_square]
 
-            gs.move(move)
+            gs.make_move(move)
             quiet_move = m >= noisy_moves_len
             
             # extended futility pruning
@@ -380,27 +618,25 @@ def negamax_root(gs, depth, alpha, beta, trans_table, moves = None, allow_null =
                 and material_left(gs, gs.cur_player) > 3
             ):
                 if -material_balance(gs) + fmargins[depth] <= alpha:
-                    gs.undo()
+                    gs.unmake_move()
                     continue
             
             # late move reduction and razoring
+            r = 0
             if (
                 depth >= 3
                 and not gs.check
                 and (m >= noisy_moves_len + 3 or (quiet_move and depth == 3 and -material_balance(gs) + fmargins[3] <= alpha))
             ):
                 r = max(2, depth//3) if m > noisy_moves_len + 10 else 1
-                score = -negamax(gs, depth - r - 1, -beta, -alpha, trans_table)
-                if score > alpha:
-                    score = -negamax(gs, depth - 1, -beta, -alpha, trans_table)
-            else:
-                score = -negamax(gs, depth - 1, -beta, -alpha, trans_table)
+            score = search_move(gs, depth - 1, r, alpha, beta, trans_table, searched)
+            searched = True
 
-            gs.undo()
+            gs.unmake_move()
 
             if trans_table[-1] == 0:
                 if end_piece == 12:
-                    history_table[move, gs.cur_player]["freq"] += 1
+                    history_tries[move_index(move, gs.cur_player)] += 1
 
                 if score >= best_score:
                     best_score = score
@@ -412,11 +648,7 @@ def negamax_root(gs, depth, alpha, beta, trans_table, moves = None, allow_null =
 
                 if alpha >= beta:
                     if end_piece == 12:
-                        if move not in killer_table[depth]:
-                            killer_table[depth].append(move)
-                        history_table[move, gs.cur_player]["killer"] += 2**depth
-                        counter_move_table[move, gs.cur_player] = gs.prev_moves[-1] if gs.prev_moves else None
-                        killer_table[depth] = killer_table[depth][-3:]             
+                        store_cutoff(gs, move, depth)
                     break
 
         if trans_table[-1] == 0:
@@ -441,25 +673,36 @@ def negamax_root(gs, depth, alpha, beta, trans_table, moves = None, allow_null =
 
     return best_score
 
+# Searches the move just made, a move reduced by r plies is searched again at full
+# depth if it beats alpha. With principal variation search, once one move of the
+# node has been searched the others only need to be shown to be no better, so they
+# get a null window and the full window only when they turn out better.
+def search_move(gs, depth, r, alpha, beta, trans_table, searched):
+    scout = pv_scout and searched and beta - alpha > 1
+    if r:
+        score = -negamax(gs, depth - r, -alpha - 1 if scout else -beta, -alpha, trans_table)
+        if score <= alpha:
+            return score
+    if scout:
+        score = -negamax(gs, depth, -alpha - 1, -alpha, trans_table)
+        if not alpha < score < beta:
+            return score
+    return -negamax(gs, depth, -beta, -alpha, trans_table)
+
 def negamax(gs, depth, alpha, beta, trans_table, allow_null=True):
     best_score = -INFINITY
     best_move = (0, 0)
 
-    if round(time.time()*1000) - get_time(trans_table, "start") > get_time(trans_table, "max") * 0.99:
-        trans_table[-1] = 1
-
     if trans_table[-1] == 0:
-        node_count(trans_table, "add")
-        if gs.checkmate:
-            return -MATESCORE - depth
-        elif gs.stalemate or gs.draw:
+        count_node(trans_table)
+        if gs.halfmove >= 100 or gs.is_repetition(2) or gs.insufficient():
             return 0
         
         alpha_og = alpha
-        zobrist = hash(gs)
+        zobrist = gs.zobrist
         tt_entry = get_tt(trans_table, zobrist)
 
-        if gs.all_board_positions.count(gs.all_board_positions[-1]) < 2 and tt_entry:
+        if tt_entry and not gs.is_repetition():
             tt_score, tt_flag, tt_depth, tt_move = tt_entry
             if tt_depth >= depth and tt_move != (1, 1):
                 if tt_score < -CHECKMATE:
@@ -487,7 +730,7 @@ def negamax(gs, depth, alpha, beta, trans_table, allow_null=True):
             and abs(alpha) < CHECKMATE
             and abs(beta) < CHECKMATE
         ):
-            fut_eval = pesto(gs) - fmargin
+            fut_eval = evaluate(gs) - fmargin
             if fut_eval >= beta:
                 return fut_eval
 
@@ -498,9 +741,9 @@ def negamax(gs, depth, alpha, beta, trans_table, allow_null=True):
             and allow_null
         ):
             r = 4 if depth > 6 else 3
-            make_null_move(gs)
+            gs.make_null_move()
             score = -negamax(gs, depth - r - 1, -beta, -beta + 1, trans_table, False)
-            make_null_move(gs)
+            gs.unmake_null_move()
 
             if score >= beta:
                 depth -= 4
@@ -511,15 +754,15 @@ def negamax(gs, depth, alpha, beta, trans_table, allow_null=True):
             elif score < -CHECKMATE:
                 threat = True
 
-        valid_moves = order_moves(gs, get_valid_moves(gs), depth)   
-        noisy_moves_len = valid_moves[1]
-        valid_moves = valid_moves[0]
+        picker = MovePicker(gs, tt_entry[3] if tt_entry else None)
+        if picker.count == 0:
+            return -MATESCORE - depth
 
-        for m, move in enumerate(valid_moves):
+        m, quiets, searched = -1, 0, False
+        for m, (move, quiet_move) in enumerate(picker):
             if trans_table[-1] != 0:
                 break
             
-            move = valid_moves[m]
             start_square = move[0]
             promo_move = gs.promo_move(start_square)
             end_square = move[1] if not promo_move else gs.parse_promo(start_square, move[1])[0]
@@ -527,16 +770,16 @@ def negamax(gs, depth, alpha, beta, trans_table, allow_null=True):
 
             ext = (
                 threat or                                                    # mate threat extension
-                len(valid_moves) == 1 or                                     # one reply extension
+                picker.count == 1 or                                         # one reply extension
                 gs.check or                                                  # check extension
                 promo_move                                                   # promotion extension
                 # add recapture extension
             )
 
-            gs.move(move)
+            gs.make_move(move)
             
             ext = False if gs.check else ext
-            quiet_move = m >= noisy_moves_len
+            quiets += quiet_move
 
             # extended futility pruning
             if (
@@ -549,28 +792,27 @@ def negamax(gs, depth, alpha, beta, trans_table, allow_null=True):
                 and material_left(gs, gs.cur_player) > 3
             ):
                 if -material_balance(gs) + fmargin <= alpha:
-                    gs.undo()
+                    gs.unmake_move()
                     continue
 
             # late move reduction and razoring
+            r = 0
             if (
                 depth >= 3
                 and not ext
                 and not gs.check
-                and (m >= noisy_moves_len + 3 or (quiet_move and depth == 3 and -material_balance(gs) + fmargin <= alpha))
+                and quiet_move
+                and (quiets > 3 or (depth == 3 and -material_balance(gs) + fmargin <= alpha))
             ):
-                r = max(2, depth//3) if m > noisy_moves_len + 10 else 1
-                score = -negamax(gs, depth - r - 1, -beta, -alpha, trans_table)
-                if score > alpha:
-                    score = -negamax(gs, depth - 1, -beta, -alpha, trans_table)
-            else:
-                score = -negamax(gs, depth - 1 + ext, -beta, -alpha, trans_table)
+                r = max(2, depth//3) if quiets > 11 else 1
+            score = search_move(gs, depth - 1 + ext, r, alpha, beta, trans_table, searched)
+            searched = True
 
-            gs.undo()
+            gs.unmake_move()
 
             if trans_table[-1] == 0:
                 if end_piece == 12:
-                    history_table[move, gs.cur_player]["freq"] += 1
+                    history_tries[move_index(move, gs.cur_player)] += 1
 
                 if score >= best_score:
                     best_score = score
@@ -580,13 +822,13 @@ def negamax(gs, depth, alpha, beta, trans_table, allow_null=True):
                 
                 if alpha >= beta:
                     if end_piece == 12:
-                        if move not in killer_table[depth]:
-                            killer_table[depth].append(move)
-                        history_table[move, gs.cur_player]["killer"] += 2**depth
-                        counter_move_table[move, gs.cur_player] = gs.prev_moves[-1] if gs.prev_moves else None
-                        killer_table[depth] = killer_table[depth][-3:]
+                        store_cutoff(gs, move, depth)
                     break
 
+        # no legal moves and not in check
+        if m < 0:
+            return 0
+
         if trans_table[-1] == 0: 
             tt_flag = (
                 2 # upperbound
@@ -613,12 +855,14 @@ def negamax(gs, depth, alpha, beta, trans_table, allow_null=True):
     return best_score
 
 def MTDF(gs, guess, depth, trans_table): 
+    global root_searches
     lower = -INFINITY
     upper = INFINITY
     score = guess
     window = 55
 
     while lower < upper and trans_table[-1] == 0:
+        root_searches += 1
         beta = score + window if score == lower else score
         score = negamax_root(gs, depth, beta - window, beta, trans_table)
         if score < beta:
@@ -627,33 +871,65 @@ def MTDF(gs, guess, depth, trans_table):
             lower = score
     return score
 
-def get_move(args):
+# Aspiration windows around the previous iteration's score, widened on the side the
+# search fails on until the score lands inside
+def aspiration(gs, guess, depth, trans_table):
+    global root_searches
+    window = 50
+    alpha, beta = -INFINITY, INFINITY
+    if depth > 1 and abs(guess) < CHECKMATE:
+        alpha, beta = guess - window, guess + window
+
+    while True:
+        root_searches += 1
+        score = negamax_root(gs, depth, alpha, beta, trans_table)
+        if trans_table[-1] != 0:
+            return score
+        if score <= alpha and alpha > -INFINITY:
+            alpha = max(score - window, -INFINITY)
+        elif score >= beta and beta < INFINITY:
+            beta = min(score + window, INFINITY)
+        else:
+            return score
+        window *= 2
+
+# Search drivers of an iteration, root_searches counts their calls of negamax_root
+# during the current search so the drivers' re-searches can be compared. Null
+# window scouting is only used by the aspiration driver, MTD(f) is left as it was.
+drivers = {"mtdf": MTDF, "pvs": aspiration}
+root_searches, pv_scout = 0, False
+
+def get_move(gs, max_depth, eval_hash, driver="mtdf"):
     global guess
-    global nodes
-    gs, max_depth = args
+    global nodes, book, root_searches, pv_scout
+    age_history()
+    if eval_hash != eval_hash_mb or eval_hash and not eval_keys:
+        resize_eval_cache(eval_hash)
+    eval_stats[0], eval_stats[1] = 0, 0
     choices = [-1, 0, -1, -1, -1, -1, 0, -1, -1, 0, -1, 0, 0, -1, 0, -1, 0, 0, 0, 0, 0, 0, 0, 0, 0, -1, -1, 0, -1, -1, 0, -1, 0, 0, 0, 0, -1, 0, 0, -1, 0, -1, 0, 0, -1, -1, -1, 0, -1, 0]
     choices2 = [0, -1, -1, -1, -1, 0, -1, -1, 0, -1, 0, -1, -1, 0, -1, 0, -1, 0, -1, -1, 0, 0, 0, -1, -1, -1, 0, -1, 0, 0, -1, 0, 0, -1, -1, 0, 0, 0, 0, 0, 0, -1, -1, 0, 0, -1, 0, -1, -1, 0]
-    tt_path = os.path.join(current_dir, "t.dat")
-    with open(tt_path, "r+b") as f:
-        fd = f.fileno()
-        trans_table = mmap.mmap(fd, 0, access=mmap.ACCESS_WRITE)
-
-    nodes = 0
+    nodes, root_searches, pv_scout = 0, 0, driver == "pvs"
     cur_depth = 1
+    read_limits()
     fen = gs.all_board_positions[-1]
-    book_path = os.path.join(current_dir, "komodo.bin")
-
-    with chess.polyglot.open_reader(book_path) as reader:
-        board = chess.Board(fen)
-        moves = []
-        for entry in reader.find_all(board):
-            best = str(entry.move)
-            parsed = (gs.parse_loc(best[:2]), gs.parse_loc(best[2:]))
-            moves.append(parsed)
-        if moves:
-            set_best(trans_table, 0, moves[0], 1)
-            trans_table[-1] = 1
-            return 1
+
+    # mated or stalemated, there is nothing to search
+    if not get_valid_moves(gs):
+        trans_table[-1] = 1
+        return eval_stats + [root_searches]
+
+    if book is None:
+        book = chess.polyglot.open_reader(os.path.join(current_dir, "komodo.bin"))
+    board = chess.Board(fen)
+    moves = []
+    for entry in book.find_all(board):
+        best = str(entry.move)
+        parsed = (gs.parse_loc(best[:2]), gs.parse_loc(best[2:]))
+        moves.append(parsed)
+    if moves:
+        set_best(trans_table, 0, moves[0], 1)
+        trans_table[-1] = 1
+        return eval_stats + [root_searches]
 
     if material_left(gs) <= 4:
         no_cap = 1 in [material_left(gs, 0), material_left(gs, 1)]
@@ -664,7 +940,7 @@ def get_move(args):
             fen = gs.all_board_positions[-1]
             board = chess.Board(fen)
             wdl = -egtb.probe_wdl(board)
-            wdl = 0 if gs.all_board_positions.count(gs.all_board_positions[-1]) > 1 else wdl
+            wdl = 0 if gs.is_repetition() else wdl
             wdls.append(wdl)
             if no_cap:
                 dtz = -egtb.probe_dtz(board)
@@ -680,17 +956,85 @@ def get_move(args):
         else:
             negamax_root(gs, min(max_depth, 4), -INFINITY, INFINITY, trans_table, valid_moves)
         trans_table[-1] = 1
-        return 1
+        set_nodes(trans_table, node_slot, nodes)
+        return eval_stats + [root_searches]
         
     guess = (guess[0] if guess[1] == gs.cur_player else -guess[0], gs.cur_player)
 
-    # iterative deepening
+    # iterative deepening, with a time limit no new iteration starts after the soft
+    # limit, stretched while the best move keeps changing, or when the next iteration
+    # is not expected to finish before the hard limit
+    best_changes, prev_move, iter_time = 0, None, 0
     while cur_depth <= max_depth and trans_table[-1] == 0:
-        guess = (MTDF(gs, guess[0], cur_depth, trans_table), gs.cur_player)
+        iter_start = time.time()
+        guess = (drivers[driver](gs, guess[0], cur_depth, trans_table), gs.cur_player)
         if abs(guess[0]) > CHECKMATE:
             break
         cur_depth += 1
         depth_reach(trans_table, "set", max(cur_depth, depth_reach(trans_table, "get")))
 
+        if deadline and trans_table[-1] == 0:
+            best = get_best(trans_table, cur_depth - 1)
+            move = best[1] if best else None
+            best_changes = best_changes / 2 + (prev_move is not None and move != prev_move)
+            prev_move = move
+            now = time.time()
+            # each iteration is assumed to take as much longer than the last as that one did
+            growth = min(max((now - iter_start) / iter_time, 2), 8) if iter_time else 4
+            iter_time = max(now - iter_start, 1e-3)
+            if (
+                now - start_time > min(soft_time * (1 + best_changes), hard_time)
+                or now + iter_time * growth > deadline
+            ):
+                break
+
     trans_table[-1] = 1
-    return 1
+    set_nodes(trans_table, node_slot, nodes)
+    return eval_stats + [root_searches]
+
+def uci_move(gs, move):
+    promo_offs = {'na': 0, 'n': 4, 'b': 8, 'r': 12, 'q': 16}
+    promo = move[4] if len(move) > 4 else 'na'
+    promo = promo_offs[promo]
+    return (gs.parse_loc(move[:2]), gs.parse_loc(move[2:4]) + promo)
+
+# Search process kept for the whole session. It attaches the table and opens the book
+# once, keeps its own board and ordering tables between searches and is only sent
+# position changes and search requests over conn:
+# ("backend", name), ("position", fen, moves), ("moves", moves), ("go", max depth,
+# eval hash size) answered with the eval cache stats, and ("quit",)
+def search_worker(conn, tt_name, slot):
+    global node_slot
+    attach_tt(tt_name)
+    node_slot = slot
+    gs = GameState()
+    fen, played = None, []
+
+    while True:
+        command, *params = conn.recv()
+        if command == "backend":
+            gs = backends[params[0]]()
+        elif command == "position":
+            fen, played = params[0], list(params[1])
+            gs.build_fen(fen)
+            for move in played:
+                gs.move(uci_move(gs, move))
+        elif command == "moves":
+            played += params[0]
+            for move in params[0]:
+                gs.move(uci_move(gs, move))
+        elif command == "go":
+            # a failed search still answers and the board is rebuilt, so the worker
+            # lives on for the next search
+            try:
+                result = get_move(gs, *params)
+            except Exception:
+                traceback.print_exc()
+                trans_table[-1] = 1
+                result = eval_stats + [root_searches]
+                gs.build_fen(fen)
+                for move in played:
+                    gs.move(uci_move(gs, move))
+            conn.send(result)
+        elif command == "quit":
+            break
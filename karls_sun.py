@@ -1,4 +1,4 @@
-import subprocess, os
+import subprocess, os, threading
 
 interpreter = "pypy" if "pypy" in os.environ["PATH"] else "python"
 
@@ -9,12 +9,22 @@ engine_process = subprocess.Popen(
     universal_newlines=True
 )
 
+# Engine output is relayed as it comes, so commands like stop and ponderhit reach
+# the engine while it searches. Blank lines only end the engine's replies.
+def relay_output():
+    for response in engine_process.stdout:
+        response = response.strip()
+        if response != "":
+            print(response, flush=True)
+
+relay = threading.Thread(target=relay_output, daemon=True)
+relay.start()
+
 while True:
     command = input().strip()
     engine_process.stdin.write(f"{command}\n")
     engine_process.stdin.flush()
-
-    response = engine_process.stdout.readline().strip()
-    while response != "":
-        print(response)
-        response = engine_process.stdout.readline().strip()
+    if command == "quit":
+        engine_process.wait()
+        relay.join()
+        break
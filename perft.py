@@ -0,0 +1,46 @@
+import sys, time
+from engine import *
+
+# (name, fen, expected leaf counts for depth 1, 2, ...)
+positions = [
+    ("startpos", "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1", [20, 400, 8902, 197281, 4865609]),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1", [48, 2039, 97862, 4085603]),
+    ("position 3", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", [14, 191, 2812, 43238, 674624]),
+    ("position 4", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1", [6, 264, 9467, 422333]),
+    ("position 5", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8", [44, 1486, 62379, 2103487]),
+    ("position 6", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10", [46, 2079, 89890, 3894594]),
+    ("illegal enpassant", "3k4/3p4/8/K1P4r/8/8/8/8 b - - 0 1", [18, 92, 1670, 10138]),
+    ("enpassant gives check", "8/8/4k3/8/2p5/8/B2P2K1/8 w - - 0 1", [13, 102, 1266, 10276]),
+    ("short castle gives check", "5k2/8/8/8/8/8/8/4K2R w K - 0 1", [15, 66, 1198, 6399]),
+    ("long castle gives check", "3k4/8/8/8/8/8/8/R3K3 w Q - 0 1", [16, 71, 1286, 7418]),
+    ("castle rights", "r3k2r/1b4bq/8/8/8/8/7B/R3K2R w KQkq - 0 1", [26, 1141, 27826, 1274206]),
+    ("castling prevented", "r3k2r/8/3Q4/8/8/5q2/8/R3K2R b KQkq - 0 1", [44, 1494, 50509, 1720476]),
+    ("promote out of check", "2K2r2/4P3/8/8/8/8/8/3k4 w - - 0 1", [11, 133, 1442, 19174]),
+    ("discovered check", "8/8/1P2K3/8/2n5/1q6/8/5k2 b - - 0 1", [29, 165, 5160, 31961]),
+    ("promote to give check", "4k3/1P6/8/8/8/8/K7/8 w - - 0 1", [9, 40, 472, 2661]),
+    ("underpromote to give check", "8/P1k5/K7/8/8/8/8/8 w - - 0 1", [6, 27, 273, 1329]),
+    ("self stalemate", "K1k5/8/P7/8/8/8/8/8 w - - 0 1", [2, 6, 13, 63]),
+    ("stalemate and checkmate", "8/k1P5/8/1K6/8/8/8/8 w - - 0 1", [10, 25, 268, 926]),
+]
+
+# usage: perft.py [max depth] [mailbox|bitboard]
+if __name__ == '__main__':
+    max_depth = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    backend = sys.argv[2] if len(sys.argv) > 2 else "mailbox"
+    gs = backends[backend]()
+    total_nodes, total_time, failed = 0, 0, 0
+
+    for name, fen, counts in positions:
+        for depth, expected in enumerate(counts[:max_depth], 1):
+            gs.build_fen(fen)
+            start_time = time.time()
+            nodes = perft(gs, depth)
+            elapsed = time.time() - start_time
+            total_nodes += nodes
+            total_time += elapsed
+            status = "ok" if nodes == expected else "FAIL"
+            failed += nodes != expected
+            print(f"{status:4} {name:27} depth {depth} expected {expected:8} actual {nodes:8} time {round(elapsed*1000):6} nps {round(nodes/max(elapsed, 1e-6))}")
+
+    print(f"{backend}: {failed} failed, nodes {total_nodes} time {round(total_time*1000)} nps {round(total_nodes/max(total_time, 1e-6))}")
+    sys.exit(1 if failed else 0)
@@ -1,43 +1,142 @@
-data_size = 13 # bytes
+import struct, mmap
+
+# The table is split into 64 byte buckets of four 16 byte entries, followed by one
+# 64 byte node count slot per search process and ~0.5kb of other search info. The
+# first three entries of a bucket keep the deepest results of the current search,
+# the last one always takes the newest result.
+# An entry is two 64 bit words, data and key ^ data, so an entry torn by another
+# process writing at the same time fails the key check instead of being misread.
+# data: score (16 bits) | depth (8) | flag (8) | move from (8) | move to (8) | age (8)
+bucket_size = 64
+entry_size = 16
+entries_per_bucket = 4
+node_slots = 64
+info_size = 520 + node_slots * 64
 INFINITY = 15000
 
-def extract_components(data):
-    move_to = data & 0x7f
-    move_from = (data >> 7) & 0x3F
-    depth = (data >> 13) & 0x3F
-    flag = (data >> 19) & 0x3
-    score = (data >> 21) & 0xFFFF
-    hash_key = (data >> 37) & 0xFFFFFFFFFFFFFFFF
-    return hash_key, score, flag, depth, move_from, move_to
+# Saved tables start with a header naming the file format and the hashing scheme,
+# files from an older format or with other keys are refused
+file_magic = b"KSTT"
+file_version = 1
+key_scheme = 1 # Polyglot Zobrist keys
+header_format = "<4sHHQ"
+
+def bucket_count(tt):
+    return (len(tt) - info_size) // bucket_size
+
+def get_age(tt):
+    return tt[len(tt) - 100]
 
-def verify_tt(data, key):
-    hash_key, score, flag, depth, move_from, move_to = extract_components(data)
-    data = (score & 0xFFFF) << 21 | (flag & 0x3) << 19 | (depth & 0x3F) << 13 | (move_from & 0x3F) << 7 | move_to & 0x7f
-    return [score, flag, depth, (move_from, move_to)] if hash_key ^ data == key else False
+# Starts a new search generation, entries from earlier searches are replaced first
+def new_search(tt):
+    tt[len(tt) - 100] = (get_age(tt) + 1) & 0xFF
 
 def store_tt(tt, hash_key, score, flag, depth, move):
-    tt_size = len(tt) - 520 # using final ~0.5kb for other info
+    age = get_age(tt)
     move_from, move_to = move
-    score = score + INFINITY + 1
-    data = (score & 0xFFFF) << 21 | (flag & 0x3) << 19 | (depth & 0x3F) << 13 | (move_from & 0x3F) << 7 | move_to & 0x7f
-    data = ((hash_key ^ data) & 0xFFFFFFFFFFFFFFFF) << 37 | (score & 0xFFFF) << 21 | (flag & 0x3) << 19 | (depth & 0x3F) << 13 | (move_from & 0x3F) << 7 | move_to & 0x7f
-    data_bytes = data.to_bytes(data_size, byteorder='little')
-    byte_start = (hash_key % (tt_size//data_size)) 
-    tt[byte_start:byte_start + data_size] = data_bytes
+    data = (
+        (score & 0xFFFF)
+        | (depth & 0xFF) << 16
+        | (flag & 0xFF) << 24
+        | (move_from & 0xFF) << 32
+        | (move_to & 0xFF) << 40
+        | age << 48
+    )
+
+    store_entry(tt, hash_key, data)
+
+def store_entry(tt, hash_key, data):
+    base = hash_key % bucket_count(tt) * bucket_size
+    bucket = struct.unpack_from("<8Q", tt, base)
+    age = get_age(tt)
+
+    # Same position or an empty entry first, else the shallowest of the depth preferred
+    # entries if the new result is at least as deep, entries of older searches count
+    # as shallower than any current one. Shallower results go to the always replace entry.
+    slot = None
+    for i in range(entries_per_bucket):
+        entry_data = bucket[2 * i + 1]
+        if not entry_data or bucket[2 * i] ^ entry_data == hash_key:
+            slot = i
+            break
+
+    if slot is None:
+        values = [
+            (bucket[2 * i + 1] >> 16 & 0xFF) - 256 * ((age - (bucket[2 * i + 1] >> 48)) & 0xFF)
+            for i in range(entries_per_bucket - 1)
+        ]
+        slot = values.index(min(values))
+        if data >> 16 & 0xFF < values[slot]:
+            slot = entries_per_bucket - 1
+
+    struct.pack_into("<2Q", tt, base + slot * entry_size, hash_key ^ data, data)
 
 def get_tt(tt, hash_key):
-    tt_size = len(tt) - 520 # using final ~0.5kb for other info
-    byte_start = (hash_key % (tt_size//data_size))
-    byte_end = byte_start + data_size
-    extracted_data_bytes = tt[byte_start:byte_end]
-    extracted_data = int.from_bytes(extracted_data_bytes, byteorder='little')
-    data = verify_tt(extracted_data, hash_key)
-    if data:
-        data[0] -= (INFINITY + 1)
-        return data
-    else:
-        return None
-        
+    base = hash_key % bucket_count(tt) * bucket_size
+    bucket = struct.unpack_from("<8Q", tt, base)
+    for i in range(0, 2 * entries_per_bucket, 2):
+        data = bucket[i + 1]
+        if bucket[i] ^ data == hash_key and data:
+            score = data & 0xFFFF
+            score = score - 0x10000 if score & 0x8000 else score
+            return [score, data >> 24 & 0xFF, data >> 16 & 0xFF, (data >> 32 & 0xFF, data >> 40 & 0xFF)]
+    return None
+
+# Permille of the first thousand entries written during the current search
+def hashfull(tt):
+    age = get_age(tt)
+    count = min(1000 // entries_per_bucket, bucket_count(tt))
+    used = 0
+    for bucket in range(count):
+        words = struct.unpack_from("<8Q", tt, bucket * bucket_size)
+        for i in range(1, 2 * entries_per_bucket, 2):
+            if words[i] and words[i] >> 48 == age:
+                used += 1
+    return used * 1000 // max(1, count * entries_per_bucket)
+
+# Writes the used entries of the table to path, returns how many were written
+def save_tt(tt, path):
+    table = tt[:bucket_count(tt) * bucket_size]
+    chunk = 1 << 16
+    count = 0
+    with open(path, "wb") as f:
+        f.write(struct.pack(header_format, file_magic, file_version, key_scheme, 0))
+        for start in range(0, len(table), chunk):
+            block = bytes(table[start:start + chunk])
+            # most of a fresh table is empty, skip those blocks without unpacking
+            if block.count(0) == len(block):
+                continue
+            entries = bytearray()
+            for check, data in struct.iter_unpack("<2Q", block):
+                if data:
+                    entries += struct.pack("<2Q", check, data)
+            count += len(entries) // entry_size
+            f.write(entries)
+        f.seek(0)
+        f.write(struct.pack(header_format, file_magic, file_version, key_scheme, count))
+    return count
+
+# Rehashes the entries saved in path into the table, which may be of any size.
+# The file is mapped read-only so it is paged in as it is read.
+# Returns how many entries were read, None if the file can't be used.
+def load_tt(tt, path):
+    header_size = struct.calcsize(header_format)
+    with open(path, "rb") as f:
+        header = f.read(header_size)
+        if len(header) < header_size:
+            return None
+        magic, version, scheme, count = struct.unpack(header_format, header)
+        if (magic, version, scheme) != (file_magic, file_version, key_scheme):
+            return None
+        if not count:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as saved:
+            # a view of the mapping, slicing the mapping itself would copy the whole file
+            with memoryview(saved)[header_size:header_size + count * entry_size] as entries:
+                for check, data in struct.iter_unpack("<2Q", entries):
+                    store_entry(tt, check ^ data, data)
+    return count
+
 def set_best(tt, score, move, depth):
     ind = (depth - 1) * 4
     byte_start = len(tt) - 520 + ind
@@ -60,6 +159,8 @@ def get_best(tt, ind = -1):
             best.append((score, move, i + 1))
             if score > 14000:
                 break
+    if not best:
+        return None
     ind = max(-len(best), ind)
     return best[-1] if ind > 0 else best[ind]
 
@@ -68,34 +169,48 @@ def clear_best(tt):
     for i in range(400):
         tt[byte_start + i] = 0
 
+# Every search process counts nodes locally and publishes them to its own slot,
+# a cache line apart so the processes don't contend for it
+def set_nodes(tt, slot, nodes):
+    byte_start = len(tt) - info_size + (slot % node_slots) * 64
+    tt[byte_start:byte_start+8] = nodes.to_bytes(8, byteorder='little')
+
 def node_count(tt, arg):
-    byte_start = len(tt) - 120 + 5
-    node_bytes = tt[byte_start:byte_start+4]
-    node_count = int.from_bytes(node_bytes, byteorder='little')
+    byte_start = len(tt) - info_size
     if arg == "get":
-        return node_count
-    if arg == "add":
-        node_count += 1
+        return sum(
+            int.from_bytes(tt[byte_start + slot * 64:byte_start + slot * 64 + 8], byteorder='little')
+            for slot in range(node_slots)
+        )
     elif arg == "clear":
-        node_count = 0
-    node_bytes = node_count.to_bytes(4, byteorder='little')
-    tt[byte_start:byte_start+4] = node_bytes
+        for slot in range(node_slots):
+            set_nodes(tt, slot, 0)
+
+# Search times in ms as (offset from len - 120, byte length): the start time, the
+# hard limit the search is stopped at and the soft limit no new iteration starts after
+time_fields = {"max": (0, 4), "soft": (4, 4), "start": (11, 6)}
 
 def set_time(tt, time, arg):
-    off = 9 if arg == "max" else 11
+    off, byte_len = time_fields[arg]
     byte_start = len(tt) - 120 + off
-    byte_len = 2 if arg == "max" else 6 
     time_bytes = time.to_bytes(byte_len, byteorder='little')
     tt[byte_start:byte_start+byte_len] = time_bytes
 
 def get_time(tt, arg):
-    off = 9 if arg == "max" else 11
+    off, byte_len = time_fields[arg]
     byte_start = len(tt) - 120 + off
-    byte_len = 2 if arg == "max" else 6 
     time_bytes = tt[byte_start:byte_start+byte_len]
     time = int.from_bytes(time_bytes, byteorder='little')
     return time
 
+# Set while the search runs on the opponent's time, the time limits only apply
+# once it is cleared by ponderhit
+def set_ponder(tt, ponder):
+    tt[len(tt) - 112] = ponder
+
+def get_ponder(tt):
+    return tt[len(tt) - 112]
+
 def depth_reach(tt, arg, depth = None):
     byte_start = len(tt) - 103
     byte_len = 2
@@ -1,14 +1,18 @@
 import re
+import threading
 import multiprocessing as mp
 from engine import *
 
 def parse_command(command):
     uci_pattern = re.compile(r'^uci$')
     isready_pattern = re.compile(r'^isready$')
+    setoption_pattern = re.compile(r'^setoption\s+name\s+(.*?)(\s+value\s+(.*))?$')
     position_pattern = re.compile(r'^position\s+(startpos|fen\s+(.*?))(\s+moves\s+(.*))?$')
-    go_pattern = re.compile(r'^go\s+(.*)$')
+    go_pattern = re.compile(r'^go\b\s*(.*)$')
+    perft_pattern = re.compile(r'^perft\s+(divide\s+)?(\d+)$')
     move_pattern = re.compile(r'^move\s+(\w\d)\s+(\w\d)(\s*([qrbn]))?$')
     stop_pattern = re.compile(r'^stop$')
+    ponderhit_pattern = re.compile(r'^ponderhit$')
     ucinewgame_pattern = re.compile(r'^ucinewgame$')
     quit_pattern = re.compile(r'^quit$')
 
@@ -16,6 +20,8 @@ def parse_command(command):
         return 'uci', None
     elif isready_pattern.match(command):
         return 'isready', None
+    elif setoption_match := setoption_pattern.match(command):
+        return 'setoption', setoption_match.group(1), setoption_match.group(3)
     elif position_match := position_pattern.match(command):
         fen = position_match.group(2) if position_match.group(2) else 'startpos'
         moves = position_match.group(4)
@@ -23,6 +29,10 @@ def parse_command(command):
     elif go_match := go_pattern.match(command):
         params = go_match.group(1)
         return 'go', params
+    elif perft_match := perft_pattern.match(command):
+        divide = perft_match.group(1) is not None
+        depth = int(perft_match.group(2))
+        return 'perft', depth, divide
     elif move_match := move_pattern.match(command):
         move_from = move_match.group(1)
         move_to = move_match.group(2)
@@ -30,6 +40,8 @@ def parse_command(command):
         return 'move', move_from, move_to, promotion
     elif stop_pattern.match(command):
         return 'stop', None
+    elif ponderhit_pattern.match(command):
+        return 'ponderhit', None
     elif ucinewgame_pattern.match(command):
         return 'ucinewgame', None
     elif quit_pattern.match(command):
@@ -52,80 +64,261 @@ def parse_engine_move(move):
     return f"{game.parse_index(start)}{game.parse_index(end)}{promo_piece}"
 
 def parse_uci_move(move):
-    promo_offs = {'na': 0, 'n': 4, 'b': 8, 'r': 12, 'q': 16}
-    promo = move[4] if len(move) > 4 else 'na'
-    promo = promo_offs[promo]
-    return (game.parse_loc(move[:2]), game.parse_loc(move[2:4]) + promo)
+    return uci_move(game, move)
+
+# Soft and hard time limits in ms for a move from the clock. The soft limit is an
+# even share of the time left plus most of the increment, the hard limit gives an
+# unstable search up to four times that. Both keep a margin for the GUI's overhead.
+def allocate_time(time_left, inc, moves_to_go):
+    time_left = max(time_left - move_overhead, 1)
+    soft = min(time_left // moves_to_go + inc * 3 // 4, time_left // 2)
+    hard = min(soft * 4, time_left * 3 // 4)
+    return max(soft, 1), max(hard, 1)
 
 def handle_go(params):
+    global search_thread, ponder_limits
     go = params.split()
+    limits = {go[i]: int(go[i + 1]) for i in range(len(go) - 1) if go[i + 1].lstrip('-').isdigit()}
     start_time = round(time.time()*1000)
     set_time(trans_table, start_time, "start")
     node_count(trans_table, "clear")
+    new_search(trans_table)
     clear_best(trans_table)
     depth_reach(trans_table, "set", 0)
     trans_table[-1] = 0
-    if "depth" in go:
-        max_time, max_depth = 65000, int(go[go.index("depth") + 1])
-    elif "movetime" in go:
-        max_time, max_depth = int(go[go.index("movetime") + 1]), 100
+    max_depth = limits.get("depth", 100)
+    side = "b" if game.cur_player else "w"
+    if "movetime" in limits:
+        soft_time = max_time = max(limits["movetime"], 1)
+    elif side + "time" in limits:
+        moves_to_go = min(max(limits.get("movestogo", 30), 1), 50)
+        soft_time, max_time = allocate_time(limits[side + "time"], limits.get(side + "inc", 0), moves_to_go)
+    else: # depth or infinite, searches until done or stopped
+        soft_time = max_time = 0
     
+    # a pondering search runs without limits until ponderhit, the clock is only ours
+    # then. An infinite search, or pondering before one, may not send bestmove before stop.
+    infinite = not max_time and "depth" not in limits
+    if "ponder" in go:
+        ponder_limits = (soft_time, max_time, infinite)
+        soft_time = max_time = 0
+    if "ponder" in go or infinite:
+        bestmove_allowed.clear()
+    else:
+        bestmove_allowed.set()
+    set_ponder(trans_table, "ponder" in go)
     set_time(trans_table, max_time, "max")
-    args = [(game, max_depth) for _ in range(cores)]
+    set_time(trans_table, soft_time, "soft")
+    sync_workers()
     search_time_start = time.time()
-    pool.map(get_move, args)
+    for conn in conns:
+        conn.send(("go", max_depth, eval_hash, driver))
+    search_thread = threading.Thread(target=finish_search, args=(search_time_start,), daemon=True)
+    search_thread.start()
+
+# Collects the workers' results in the background, so the main loop keeps reading
+# commands and a stop reaches the workers while they search
+def finish_search(search_time_start):
+    eval_probes, eval_hits, root_searches = map(sum, zip(*[conn.recv() for conn in conns]))
     search_time = time.time() - search_time_start
     nodes_searched = node_count(trans_table, 'get')
     score, move, depth = None, None, None
+    valid_moves = get_valid_moves(game)
     info = get_best(trans_table)
-    if not info:
-        tt_info = get_tt(trans_table, hash(game))
-        score, move, depth = tt_info[0], tt_info[3], tt_info[2]
+    if not valid_moves: # mated or stalemated, bestmove is 0000
+        score, move, depth = -MATESCORE if game.check else 0, None, 0
+    elif not info:
+        tt_info = get_tt(trans_table, game.zobrist)
+        if tt_info and tt_info[3] in valid_moves:
+            score, move, depth = tt_info[0], tt_info[3], tt_info[2]
+        else: # stopped before the first iteration finished
+            score, move, depth = 0, valid_moves[0], 0
     else:
         score, move, depth = get_best(trans_table) if get_best(trans_table)[-1] < depth_reach(trans_table, "get") else get_best(trans_table, -2)
-    print(f"info depth {depth} score cp {score} time {round(search_time*1000)} nodes {nodes_searched} nps {round(nodes_searched/search_time)}")
-    print(f"bestmove {parse_engine_move(move)}")
+    print(f"info depth {depth} score cp {score} time {round(search_time*1000)} nodes {nodes_searched} nps {round(nodes_searched/search_time)} hashfull {hashfull(trans_table)}")
+    print(f"info string evalhash probes {eval_probes} hits {eval_hits} hitrate {round(100*eval_hits/max(eval_probes, 1), 1)}%")
+    print(f"info string searchdriver {driver} rootsearches {root_searches}")
+    # bestmove is held back until ponderhit, or until stop for an infinite search
+    bestmove_allowed.wait()
+    if move:
+        reply = ponder_move(move)
+        print(f"bestmove {parse_engine_move(move)}" + (f" ponder {reply}" if reply else ""))
+    else:
+        print("bestmove 0000")
+    # the blank line that ends the reply to go comes after bestmove
+    print("", flush=True)
+
+# The expected reply to move, the table's best move in the position after it
+def ponder_move(move):
+    if move not in get_valid_moves(game):
+        return None
+    game.move(move)
+    tt_info = get_tt(trans_table, game.zobrist)
+    reply = tt_info[3] if tt_info and tt_info[3] in get_valid_moves(game) else None
+    reply = reply and parse_engine_move(reply)
+    game.undo()
+    return reply
+
+# The opponent played the expected move, the search goes on as a timed search of
+# our move from now on
+def handle_ponderhit():
+    if get_ponder(trans_table):
+        set_time(trans_table, round(time.time()*1000), "start")
+        set_time(trans_table, ponder_limits[1], "max")
+        set_time(trans_table, ponder_limits[0], "soft")
+        set_ponder(trans_table, 0)
+        if not ponder_limits[2]:
+            bestmove_allowed.set()
+
+# Commands that touch the board or the workers wait for a running search to end
+def wait_search():
+    if search_thread:
+        search_thread.join()
     
+def handle_perft(depth, divide):
+    start_time = time.time()
+    if divide:
+        counts = perft_divide(game, depth)
+        for move, count in counts:
+            print(f"{parse_engine_move(move)}: {count}")
+        nodes = sum(count for _, count in counts)
+    else:
+        nodes = perft(game, depth)
+    elapsed = time.time() - start_time
+    print(f"Nodes searched: {nodes} time {round(elapsed*1000)} nps {round(nodes/max(elapsed, 1e-6))}")
+
 def handle_position(fen, moves):
-    fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1" if fen == 'startpos' else fen
+    global position
+    fen = start_fen if fen == 'startpos' else fen
     game.build_fen(fen)
+    moves = moves.split() if moves else []
+    position = (fen, moves)
+
+    for move in moves:
+        game.move(parse_uci_move(move))
 
-    if moves:
-        moves = [
-            parse_uci_move(move) for move in moves.split()
-        ]
-        for move in moves:
-            game.move(move)
+# Brings the workers' boards up to the current position, sending only the moves
+# played since the last search when the game has just moved on
+def sync_workers():
+    global synced
+    fen, moves = position
+    if synced and synced[0] == fen and moves[:len(synced[1])] == synced[1]:
+        message = ("moves", moves[len(synced[1]):])
+    else:
+        message = ("position", fen, moves)
+    if message != ("moves", []):
+        for conn in conns:
+            conn.send(message)
+    synced = (fen, list(moves))
+
+def handle_setoption(name, value):
+    global game, eval_hash, hash_file, hash_persist, backend, synced, driver
+    if name == "Backend" and value in backends:
+        game, backend, synced = backends[value](), value, None
+        game.build_fen(position[0])
+        for move in position[1]:
+            game.move(parse_uci_move(move))
+        for conn in conns:
+            conn.send(("backend", backend))
+    elif name == "SearchDriver" and value in drivers:
+        driver = value
+    elif name == "EvalHash" and value and value.isdigit():
+        eval_hash = min(int(value), 1024)
+    elif name == "Hash" and value and value.isdigit():
+        create_tt(min(max(int(value), 1), 4096))
+    elif name == "HashFile":
+        hash_file = "" if value in (None, "<empty>") else value
+        if hash_file and os.path.exists(hash_file):
+            handle_load_hash()
+    elif name == "HashPersist" and value in ("true", "false"):
+        hash_persist = value == "true"
+    elif name == "SaveHash" and hash_file:
+        count = save_tt(trans_table, hash_file)
+        print(f"info string saved {count} hash entries to {hash_file}")
+    elif name == "LoadHash" and hash_file:
+        handle_load_hash()
+
+def handle_load_hash():
+    count = load_tt(trans_table, hash_file) if os.path.exists(hash_file) else None
+    if count is None:
+        print(f"info string {hash_file} is not a usable hash file")
+    else:
+        print(f"info string loaded {count} hash entries from {hash_file}")
+
+# (Re)creates the shared transposition table and the search processes attached to it
+def create_tt(mb):
+    global tt_shm, trans_table
+    stop_workers()
+    if tt_shm:
+        trans_table = None
+        tt_shm.close()
+        tt_shm.unlink()
+    tt_shm = shared_memory.SharedMemory(create=True, size=mb << 20)
+    trans_table = tt_shm.buf
+    start_workers()
+
+def start_workers():
+    global workers, conns, synced
+    workers, conns, synced = [], [], None
+    for slot in range(cores):
+        conn, worker_conn = mp.Pipe()
+        worker = mp.Process(target=search_worker, args=(worker_conn, tt_shm.name, slot), daemon=True)
+        worker.start()
+        conn.send(("backend", backend))
+        workers.append(worker)
+        conns.append(conn)
+
+def stop_workers():
+    for conn in conns:
+        conn.send(("quit",))
+    for worker in workers:
+        worker.join()
 
 def handle_move(move_from, move_to, promo_piece):
     promo_offs = {None: 0, 'n': 4, 'b': 8, 'r': 12, 'q': 16}
+    position[1].append(f"{move_from}{move_to}{promo_piece or ''}")
     move_to, move_from = game.parse_loc(move_to), game.parse_loc(move_from)
     move_to += promo_offs[promo_piece]
     game.move((move_from, move_to))
 
 if __name__ == '__main__':
     game = GameState()
-    cores = mp.cpu_count()//2 - 1
-    pool = mp.Pool(processes=cores)
-    tt_size = 520000000 # bytes
-    tt_path = os.path.join(current_dir, "t.dat")
-
-    with open(tt_path, "wb") as f:
-        f.truncate(tt_size)
-    
-    with open(tt_path, "r+b") as f:
-        fd = f.fileno()
-        trans_table = mmap.mmap(fd, 0, access=mmap.ACCESS_WRITE)
+    eval_hash = eval_hash_mb
+    driver = "mtdf"
+    cores = max(1, mp.cpu_count()//2 - 1)
+    start_fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+    position, backend = (start_fen, []), "mailbox"
+    workers, conns, tt_shm = [], [], None
+    search_thread, bestmove_allowed, ponder_limits = None, threading.Event(), (0, 0, False)
+    tt_mb = 512
+    move_overhead = 50 # ms kept back from the clock for the GUI and process latency
+    create_tt(tt_mb)
+    hash_file, hash_persist = "", False
 
     while True:
         command = input()
         parsed_command = parse_command(command)
         command_type = parsed_command[0]
+        if command_type not in ('uci', 'isready', 'stop', 'ponderhit', 'quit'):
+            wait_search()
 
         if command_type == 'uci':
-            print("id name Karl's Sun\nid author Izy266\nuciok")
+            print("id name Karl's Sun\nid author Izy266")
+            print("option name Ponder type check default false")
+            print("option name Backend type combo default mailbox var mailbox var bitboard")
+            print(f"option name Hash type spin default {tt_mb} min 1 max 4096")
+            print("option name SearchDriver type combo default mtdf var mtdf var pvs")
+            print(f"option name EvalHash type spin default {eval_hash_mb} min 0 max 1024")
+            print("option name HashFile type string default <empty>")
+            print("option name HashPersist type check default false")
+            print("option name SaveHash type button")
+            print("option name LoadHash type button")
+            print("uciok")
         elif command_type == 'isready':
             print("readyok")
+        elif command_type == 'setoption':
+            name, value = parsed_command[1], parsed_command[2]
+            handle_setoption(name, value)
         elif command_type == 'position':
             fen, moves = parsed_command[1], parsed_command[2]
             handle_position(fen, moves)
@@ -133,18 +326,33 @@ if __name__ == '__main__':
             trans_table[-1] = 0
             params = parsed_command[1]
             handle_go(params)
+        elif command_type == 'perft':
+            depth, divide = parsed_command[1], parsed_command[2]
+            handle_perft(depth, divide)
         elif command_type == 'move':
             move_from, move_to, promo_piece = parsed_command[1], parsed_command[2], parsed_command[3]
             handle_move(move_from, move_to, promo_piece)
         elif command_type == 'stop':
             trans_table[-1] = 1
+            bestmove_allowed.set()
+            wait_search()
+        elif command_type == 'ponderhit':
+            handle_ponderhit()
         elif command_type == 'ucinewgame':
-            game.build_fen("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1")
+            game.build_fen(start_fen)
+            position = (start_fen, [])
         elif command_type == 'quit':
-            pool.close()
-            pool.terminate()
-            trans_table.close()
-            os.remove(tt_path)
+            trans_table[-1] = 1
+            bestmove_allowed.set()
+            wait_search()
+            if hash_persist and hash_file:
+                save_tt(trans_table, hash_file)
+            stop_workers()
+            trans_table = None
+            tt_shm.close()
+            tt_shm.unlink()
             break
         
-        print("")
+        # go ends its reply from the search thread
+        if command_type != 'go':
+            print("")